@@ -6,6 +6,9 @@ class WordSpace(dict):
 	Custom dictionary which holds key variables
 	and (inevitable) returns intelligent errors.
 	"""
+
+	#---keys that are read while a stage is running (see amx.base.stages)
+	reads = None
 	
 	def __getattribute__(self,key):
 
@@ -14,7 +17,7 @@ class WordSpace(dict):
 		wordspace.step instead of wordspace['step'].
 		"""
 
-		if key in self: return self[key]
+		if dict.__contains__(self,key): return self[key]
 		else: return dict.__getattribute__(self,key)
 
 	def __setattr__(self,key,value):
@@ -37,6 +40,7 @@ class WordSpace(dict):
 		Intelligent warnings for some functions.
 		"""
 
+		if WordSpace.reads is not None: WordSpace.reads.add(key)
 		if key=='last' and key not in self:
 			raise Exception("".join([
 				"[ERROR] wordspace['last'] is not defined ...",
@@ -48,6 +52,24 @@ class WordSpace(dict):
 			elif key == 'under_development': return False
 		return dict.get(self,key)
 
+	def __contains__(self,key):
+
+		"""
+		Membership tests count as reads for stages.
+		"""
+
+		if WordSpace.reads is not None: WordSpace.reads.add(key)
+		return dict.__contains__(self,key)
+
+	def get(self,key,default=None):
+
+		"""
+		Get a value with a default. This also counts as a read for stages.
+		"""
+
+		if WordSpace.reads is not None: WordSpace.reads.add(key)
+		return dict.get(self,key,default)
+
 class WordSpaceLook():
 	def __init__(self,d): self.__dict__ = d
 	def __getitem__(self,i): return self.__dict__[i]
@@ -67,7 +89,7 @@ script_call = os.path.basename(wordspace['script'])
 if script_call == 'sphinx-build': sys.path.insert(0,os.path.abspath('../../../amx'))
 
 from base.functions import *
-from base.mdp import write_mdp
+from base.mdp import write_mdp,mdp_tree
 from base.gmxwrap import *
 from base.metatools import *
 from procedures.common import *
@@ -90,6 +112,11 @@ if (not script_call in ['sphinx-build','script-vmd.py'] and
 				'skip loading procedure codes',tag='warning')
 		#---loop over required modules and import them
 		for libfile in reqs:
+			#---most procedures supply functions and literal settings which we load on demand (see metatools)
+			namespace = procedure_namespace(libfile)
+			if namespace != None: 
+				globals().update(namespace)
+				continue
 			#---use old-school importing if importlib is not available
 			if importlib_avail: mod = importlib.import_module('amx.procedures.'+libfile)
 			else: mod = __import__('amx.procedures.%s'%libfile,fromlist=['amx.procedures.%s'%libfile])
@@ -24,6 +24,11 @@ defaults:
 	any keys in the entry will overwrite uppercase keys in the header
 	we prefer uppercase regex substitutions by AUTOMACS over bash variables
 	see the examples below for XSEDE resources
+	set gmx_cache to a directory to reuse the outputs of deterministic GROMACS commands
+	gmx_cache_size is the limit for that directory in GB (default 5)
+	gmx_cache_programs lists the cached programs (default grompp, editconf, pdb2gmx, genconf, make_ndx)
+	mdrun_flags replaces "-nt <nprocs>" in the mdrun command e.g. "-ntmpi 2 -ntomp 4 -npme 0"
+	run "make tune_mdrun <tpr>" to time mdrun and store the fastest flags for this machine and nprocs
 """
 
 compbio_cluster_header = """#!/bin/bash
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""
+Run one procedure over a sweep of settings.
+
+An ensemble is described by a spec file in the inputs folder named ensemble-<name>.py (or in a subfolder of
+inputs). The spec sets the following variables.
+
+	program  : name of a script in amx/procedures/scripts e.g. "cgmd-bilayer"
+	sweep    : dictionary from setting names to lists of values
+	settings : base settings string (optional, defaults to the settings in the program script)
+	mode     : "grid" for every combination of the values (default) or "zip" to pair them up in order
+	cores    : cores for each member (default 1) so that members * cores fits on the machine
+	label    : a setting in the sweep whose values name the members (optional)
+
+Members are named by a hash of the settings they change (or by their label) so a member keeps its folder
+when values are added to the sweep or reordered, and a member whose settings change gets a new folder.
+
+Each member of the ensemble is a separate project folder inside ensemble-<name> with links back to the amx,
+inputs and makefile in the project root. Members never share steps, logs or checkpoints. They run in
+parallel, with as many at once as the cores on this machine (or the budget given to run_ensemble) allow.
+Each member gets a copy of the machine configuration which sets nprocs to its cores so that the mdrun
+calls of concurrent members split the budget instead of competing for every core. Every member writes its
+output to log-ensemble in its folder, and the ensemble keeps a status table in status.json which is printed
+whenever a member finishes (and by "make ensemble_status <name>"). A summary with the last error reported
+by each failed member is written to summary.txt at the end. Members which finished are skipped when the
+ensemble is run again unless rerun is set. A member which runs again starts from an empty folder so that it
+never continues from the steps of an earlier attempt.
+
+The protein batch (see protein_batch_spec) is an ensemble of the atomistic protein procedure with one
+member for each structure in a folder or glob.
+"""
+
+import os,re,sys,json,time,glob,shutil,hashlib,itertools,threading,subprocess,multiprocessing
+from multiprocessing.pool import ThreadPool
+from metatools import script_settings_replace
+from tools import reverse_lines
+
+#---files and folders in the project root which every member links to
+ensemble_links = ['amx','inputs','makefile']
+
+#---appended to the configuration for each member so that the members split the cores
+#---...mdrun_flags were chosen for the whole machine (tuned flags for the smaller budget are still found)
+#---...and the cores in a custom mdrun command are set with NPROCS
+ensemble_config = """
+#---written by the ensemble runner to split the cores between members
+import re as ensemble_re
+for machine in machine_configuration.values():
+	machine['nprocs'] = %d
+	machine.pop('mdrun_flags',None)
+	for key in ['mdrun_command','mdrun']:
+		if key in machine: machine[key] = ensemble_re.sub('\\$?NPROCS',str(machine['nprocs']),machine[key])
+"""
+
+#---name of the log for each member and the status table for the ensemble
+ensemble_log_name = 'log-ensemble'
+ensemble_status_name = 'status.json'
+
+#---updates to the status table come from several threads
+ensemble_lock = threading.Lock()
+
+def ensemble_candidates():
+
+	"""
+	Available ensemble specs by name.
+	"""
+
+	found = glob.glob('inputs/ensemble-*.py')+glob.glob('inputs/*/ensemble-*.py')
+	return dict([(re.findall('^ensemble-(.+)\.py$',os.path.basename(i))[0],i) for i in found])
+
+def ensemble_spec(name):
+
+	"""
+	Load an ensemble spec by its name or a unique part of its name.
+	"""
+
+	candidates = ensemble_candidates()
+	matches = [i for i in candidates if re.search(name,i)]
+	if name in candidates: matches = [name]
+	if len(matches)!=1:
+		raise Exception('[ERROR] failed to match "%s" with one of the ensemble specs: %s'%(
+			name,', '.join(sorted(candidates.keys()))))
+	spec = {}
+	execfile(candidates[matches[0]],spec)
+	for key in ['program','sweep']:
+		if key not in spec: raise Exception('[ERROR] ensemble spec %s must set %s'%(candidates[matches[0]],key))
+	script = 'amx/procedures/scripts/script-%s.py'%spec['program']
+	if not os.path.isfile(script): raise Exception('[ERROR] cannot find script at %s'%script)
+	if 'settings' not in spec:
+		with open(script) as fp: text = fp.read()
+		spec['settings'] = re.search('settings\s*=\s*"""(.*?)"""',text,re.S).group(1)
+	spec.setdefault('name',matches[0])
+	spec.setdefault('mode','grid')
+	spec.setdefault('cores',1)
+	return dict([(k,v) for k,v in spec.items() if k!='__builtins__'])
+
+def ensemble_members(spec):
+
+	"""
+	Expand the sweep into a list of members, each with a name and the settings it changes.
+	The name depends only on the settings of the member and not on its position in the sweep.
+	"""
+
+	keys = sorted(spec['sweep'].keys())
+	if spec['mode']=='grid': combos = itertools.product(*[spec['sweep'][k] for k in keys])
+	elif spec['mode']=='zip':
+		if len(set([len(spec['sweep'][k]) for k in keys]))>1:
+			raise Exception('[ERROR] every list in the sweep must have the same length in zip mode')
+		combos = zip(*[spec['sweep'][k] for k in keys])
+	else: raise Exception('[ERROR] ensemble mode must be grid or zip but not %s'%spec['mode'])
+	if spec.get('label',None)!=None and spec['label'] not in keys:
+		raise Exception('[ERROR] the ensemble label %s is not in the sweep'%spec['label'])
+	members = []
+	for combo in combos:
+		settings = dict(zip(keys,combo))
+		if spec.get('label',None)!=None: name = re.sub('[^\w\.-]','_',str(settings[spec['label']]))
+		else: name = 'm'+hashlib.sha1(json.dumps(settings,sort_keys=True)).hexdigest()[:8]
+		members.append({'name':name,'settings':settings})
+	names = [m['name'] for m in members]
+	if len(set(names))!=len(names):
+		raise Exception('[ERROR] ensemble members must be unique but these repeat: %s'%
+			', '.join(sorted(set([i for i in names if names.count(i)>1]))))
+	return members
+
+def member_settings(settings,changes):
+
+	"""
+	Replace the values of some settings in a settings string.
+	Lines (and blocks) for the changed settings are removed and the new values are added at the end. Names
+	are matched with spaces and underscores treated alike, as they are by yamlparse.
+	"""
+
+	normal = lambda x:re.sub(' ','_',x.strip())
+	changed = [normal(i) for i in changes]
+	lines,skip = [],False
+	for line in settings.split('\n'):
+		#---lines that continue a block start with whitespace
+		if skip and re.match('^\s+\S',line): continue
+		key = re.match('^\s*(.*?)\s*:',line)
+		skip = bool(key and normal(key.group(1)) in changed)
+		if not skip: lines.append(line)
+	lines = [i for i in lines if i.strip()]
+	for key in sorted(changes):
+		lines.append('%s: %s'%(key,changes[key] if type(changes[key])==str else repr(changes[key])))
+	return '\n'+'\n'.join(lines)+'\n'
+
+def prepare_member(spec,member):
+
+	"""
+	Make the project folder for a member with links to the root and the script with its settings.
+	Anything left in the folder by an earlier run is removed first, as "make clean" would.
+	"""
+
+	path = os.path.join('ensemble-%s'%spec['name'],member['name'])
+	if os.path.isdir(path): shutil.rmtree(path)
+	os.makedirs(path)
+	for fn in ensemble_links:
+		if os.path.exists(fn) and not os.path.lexists(os.path.join(path,fn)):
+			os.symlink(os.path.abspath(fn),os.path.join(path,fn))
+	#---the member configuration is the local or global one with nprocs set to the cores for each member
+	config = 'config.py' if os.path.isfile('config.py') else os.path.join(os.environ['HOME'],'.automacs.py')
+	if os.path.isfile(config):
+		with open(config) as fp: text = fp.read()
+		with open(os.path.join(path,'config.py'),'w') as fp: fp.write(text+ensemble_config%int(spec['cores']))
+	script = os.path.join(path,'script-%s.py'%spec['program'])
+	with open('amx/procedures/scripts/script-%s.py'%spec['program']) as fp: text = fp.read()
+	with open(script,'w') as fp: fp.write(text)
+	os.chmod(script,0744)
+	script_settings_replace(script,member_settings(spec['settings'],member['settings']))
+	return path
+
+def read_status(name):
+
+	"""
+	Read the status table for an ensemble.
+	"""
+
+	fn = os.path.join('ensemble-%s'%name,ensemble_status_name)
+	if not os.path.isfile(fn): return {}
+	with open(fn) as fp: return json.load(fp)
+
+def write_status(name,status):
+
+	"""
+	Write the status table through a temporary file.
+	"""
+
+	fn = os.path.join('ensemble-%s'%name,ensemble_status_name)
+	with open(fn+'.tmp','w') as fp: json.dump(status,fp,indent=1,sort_keys=True)
+	os.rename(fn+'.tmp',fn)
+
+def status_table(status):
+
+	"""
+	Format the status of each member along with the settings it changes.
+	"""
+
+	keys = sorted(set([k for v in status.values() for k in v['settings']]))
+	rows = [['member','status','minutes']+keys]
+	for name in sorted(status):
+		entry = status[name]
+		minutes = '%.1f'%(entry['elapsed']/60.) if entry.get('elapsed')!=None else '-'
+		values = [entry['settings'].get(k,'') for k in keys]
+		rows.append([name,entry['status'],minutes]+
+			[v if type(v) in [str,unicode] else json.dumps(v) for v in values])
+	widths = [max([len(r[i]) for r in rows]) for i in range(len(rows[0]))]
+	counts = dict([(s,len([v for v in status.values() if v['status']==s]))
+		for s in set([v['status'] for v in status.values()])])
+	return '\n'.join(['  '.join([c.ljust(w) for c,w in zip(r,widths)]) for r in rows]+
+		['[STATUS] '+', '.join(['%d %s'%(counts[s],s) for s in sorted(counts)])])
+
+def run_member(spec,path,member,status):
+
+	"""
+	Run the script for one member in its own folder and record the result.
+	"""
+
+	def update(**kwargs):
+		with ensemble_lock:
+			status[member['name']].update(**kwargs)
+			write_status(spec['name'],status)
+	start = time.time()
+	update(status='running',started=start,elapsed=None,returncode=None)
+	env = dict(os.environ,OMP_NUM_THREADS=str(spec['cores']))
+	with open(os.path.join(path,ensemble_log_name),'w') as log:
+		returncode = subprocess.call([sys.executable,'script-%s.py'%spec['program']],
+			cwd=path,stdout=log,stderr=subprocess.STDOUT,env=env)
+	update(status='done' if returncode==0 else 'failed',elapsed=time.time()-start,returncode=returncode)
+	with ensemble_lock: print '[STATUS] %s %s\n%s'%(member['name'],status[member['name']]['status'],
+		status_table(status))
+	return returncode
+
+def failure_reason(path):
+
+	"""
+	Last error reported in the log for a member, or the last line if the script did not report one.
+	"""
+
+	fn = os.path.join(path,ensemble_log_name)
+	if not os.path.isfile(fn): return 'no log'
+	last = None
+	for line in reverse_lines(fn):
+		if re.match('^\[ERROR\]',line.strip()): return re.sub('^\[ERROR\]\s*','',line.strip())
+		if not last and line.strip(): last = line.strip()
+	return last if last else 'empty log'
+
+def ensemble_summary(name,status):
+
+	"""
+	Summarize the members which succeeded and failed and write the summary next to the status table.
+	"""
+
+	done = sorted([k for k,v in status.items() if v['status']=='done'])
+	failed = sorted([k for k,v in status.items() if v['status']=='failed'])
+	lines = ['[STATUS] %d of %d members succeeded'%(len(done),len(status))]
+	if done: lines.append('[STATUS] succeeded: '+' '.join(done))
+	for key in failed:
+		lines.append('[ERROR] %s failed: %s'%(key,failure_reason(os.path.join('ensemble-%s'%name,key))))
+	summary = '\n'.join(lines)
+	with open(os.path.join('ensemble-%s'%name,'summary.txt'),'w') as fp: fp.write(summary+'\n')
+	return summary
+
+def run_ensemble(name,cores=None,rerun=False,dry=False):
+
+	"""
+	Prepare every member of an ensemble and run the ones that have not finished.
+	The name may be a spec from the inputs folder or a spec dictionary (see protein_batch_spec). The number
+	of members running at once is the number of cores (on this machine by default) divided by the cores for
+	each member.
+	"""
+
+	spec = ensemble_spec(name) if type(name)!=dict else name
+	members = ensemble_members(spec)
+	status = read_status(spec['name'])
+	pending = []
+	for member in members:
+		previous = status.get(member['name'],{})
+		#---compare the settings as they were stored
+		stored = json.loads(json.dumps(member['settings']))
+		if previous.get('settings')!=stored or rerun or previous.get('status')!='done':
+			status[member['name']] = {'settings':member['settings'],'status':'pending','elapsed':None}
+			pending.append((prepare_member(spec,member),member))
+	#---members from an earlier version of the spec are dropped from the table
+	for key in [k for k in status if k not in [m['name'] for m in members]]: status.pop(key)
+	write_status(spec['name'],status)
+	workers = max(1,int(cores if cores else multiprocessing.cpu_count())/int(spec['cores']))
+	print '[STATUS] ensemble %s has %d members with %d to run on %d workers with %d cores each'%(
+		spec['name'],len(members),len(pending),min(workers,max(len(pending),1)),int(spec['cores']))
+	print status_table(status)
+	if dry or not pending: return status
+	pool = ThreadPool(min(workers,len(pending)))
+	try: pool.map(lambda x:run_member(spec,x[0],x[1],status),pending)
+	finally: pool.close()
+	print ensemble_summary(spec['name'],status)
+	return status
+
+def protein_batch_spec(structures,nprocs=None,concurrent=None,name='protein-batch'):
+
+	"""
+	Make an ensemble spec which runs the atomistic protein procedure once for each structure.
+	Structures may be a folder of PDB files or a glob. The total thread budget (nprocs, which defaults to the
+	cores on this machine) is split evenly between the members which run at once. By default each member
+	gets four threads. Members are named after their structures.
+	"""
+
+	pattern = os.path.join(structures,'*.pdb') if os.path.isdir(structures) else structures
+	pdbs = sorted([os.path.abspath(i) for i in glob.glob(os.path.expanduser(pattern))])
+	if not pdbs: raise Exception('[ERROR] no structures match %s'%pattern)
+	nprocs = int(nprocs) if nprocs else multiprocessing.cpu_count()
+	concurrent = int(concurrent) if concurrent else max(1,nprocs/4)
+	concurrent = max(1,min(concurrent,len(pdbs),nprocs))
+	names = [re.sub('[^\w-]','_',os.path.splitext(os.path.basename(i))[0]) for i in pdbs]
+	if len(set(names))!=len(names): 
+		raise Exception('[ERROR] structures in a batch must have different names: %s'%', '.join(
+			sorted(set([i for i in names if names.count(i)>1]))))
+	with open('amx/procedures/scripts/script-protein.py') as fp: text = fp.read()
+	return {'name':name,'program':'protein','mode':'zip','cores':nprocs/concurrent,'concurrent':concurrent,
+		'label':'system name',
+		'settings':re.search('settings\s*=\s*"""(.*?)"""',text,re.S).group(1),
+		'sweep':{'start structure':pdbs,'system name':names}}
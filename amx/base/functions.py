@@ -4,6 +4,8 @@ from amx import wordspace
 from amx.base.gmxwrap import report,bash
 from amx.base.journal import *
 from amx.base.tools import *
+from amx.base.store import stored_wordspace,stored_digest,checkpoint_digest,step_name
+from amx.base.manifest import project_steps,step_parts,update_manifest
 import os,shutil,re,subprocess,glob,json
 
 #---LANGUAGE FUNCTIONS
@@ -28,14 +30,11 @@ def continue_simulation_from(path,needs_topology=True):
 		step_list = []
 		raise Exception('DEV DEV DEV')
 	else:
-		#---get list of steps
-		for root,dirnames,filenames in os.walk(fullpath): break
-		steps = dict([(re.findall(step_regex,i).pop(),i) for i in dirnames if re.match(step_regex,i)])
+		#---get list of steps from the manifest of the source project
+		steps = dict([(re.findall(step_regex,i).pop(),i) for i in project_steps(root=fullpath)])
 		cwd = fullpath+'/'+steps[sorted(steps.keys())[-1]]
-	for root,dirnames,filenames in os.walk(cwd): break
 	#---get the latest step number from the CPT file list
-	lastpart = max([int(a[0]) if a else None for a in filter(None,
-		[re.findall('^md.part([0-9]{4}).cpt',f) for f in filenames])])
+	lastpart = max(step_parts(os.path.basename(cwd),suffix='cpt',root=os.path.dirname(cwd)))
 	#---copy CPT and TPR
 	incoming = ['md.part%04d.%s'%(lastpart,s) for s in ['cpt','tpr']]
 	for fn in incoming: shutil.copy(cwd+'/%s'%fn,dest+fn)
@@ -74,18 +73,14 @@ def get_last_part(suffix='cpt'):
 	"""
 
 	cwd = wordspace['step'] if 'step' in wordspace else './'
-	for root,dirnames,filenames in os.walk(os.path.abspath(cwd)): break
-	lastpart = max([int(a[0]) if a else None for a in filter(None,
-		[re.findall('^md.part([0-9]{4}).%s'%suffix,f) for f in filenames])])
+	lastpart = max(step_parts(cwd,suffix=suffix))
 	return 'md.part%04d.%s'%(lastpart,suffix)
 
 @narrate
 def get_next_part(suffix='tpr'):
 
 	cwd = wordspace['step'] if 'step' in wordspace else './'
-	for root,dirnames,filenames in os.walk(os.path.abspath(cwd)): break
-	lastpart = max([int(a[0]) if a else None for a in filter(None,
-		[re.findall('^md.part([0-9]{4}).%s'%suffix,f) for f in filenames])])
+	lastpart = max(step_parts(cwd,suffix=suffix))
 	return lastpart+1
 
 @narrate
@@ -136,8 +131,7 @@ def start(name,prefix='s'):
 	#---register root
 	detect_root_directory()
 	#---get the most recent step number
-	for root,dirnames,filenames in os.walk(os.path.abspath('.')): break
-	stepdirs = [d for d in dirnames if re.match('^%s[0-9]+'%prefix,d)]
+	stepdirs = project_steps(prefix=prefix)
 	if stepdirs == []: last_step = 0
 	else: last_step = max([int(re.findall('^%s([0-9]+)'%prefix,d).pop()) for d in stepdirs])
 
@@ -148,6 +142,7 @@ def start(name,prefix='s'):
 	if not os.path.exists(step_name): 
 		os.mkdir(step_name)
 		os.chmod(step_name,0o2775)
+	update_manifest(step_name)
 
 	wordspace['step'] = os.path.join(step_name,'')
 	#---register the step directory in the namespace
@@ -204,6 +199,51 @@ def dircopy(src,dest):
 		if not os.path.isdir(dest+'/'+os.path.basename(folder)):
 			shutil.copytree(folder,dest+'/'+os.path.basename(folder))
 		
+def read_checkpoint(logfile):
+
+	"""
+	Rebuild the wordspace from the checkpoints in a log file.
+	We read the log backwards until we reach the last full snapshot and then apply the deltas that follow it 
+	in order (see checkpoint). Logs with only full snapshots are read as before. Returns an empty dictionary 
+	if the log has no snapshot.
+	"""
+
+	regex_wordspace = '^\[CHECKPOINT\]\s+wordspace\s*=\s*(.+)'
+	regex_delta = '^\[CHECKPOINT\]\s+delta\s*=\s*(.+)'
+	deltas,state = [],None
+	for line in reverse_lines(logfile):
+		if re.match(regex_delta,line): deltas.append(re.match(regex_delta,line).group(1))
+		elif re.match(regex_wordspace,line):
+			state = json.loads(re.match(regex_wordspace,line).group(1))
+			break
+	if state == None: return {}
+	for delta in [json.loads(i) for i in deltas[::-1]]:
+		state.update(delta['set'])
+		for key in delta['unset']: state.pop(key,None)
+	return state
+
+def log_digest(step):
+
+	"""
+	Digest of the last checkpoint in the log for a step or None if the log has no checkpoint.
+	"""
+
+	logfile = 'script-%s.log'%step_name(step)
+	if not os.path.isfile(logfile): return None
+	for line in reverse_lines(logfile):
+		match = re.match('^\[CHECKPOINT\]\s(.+)',line.rstrip('\r'))
+		if match: return checkpoint_digest(match.group(1))
+	return None
+
+def store_agrees(step):
+
+	"""
+	Check that the indexed store holds the last checkpoint in the log for a step.
+	"""
+
+	digest = log_digest(step)
+	return digest != None and stored_digest(step)==digest
+
 def resume(script_settings='',add=False,read_only=False,step=None):
 
 	"""
@@ -221,17 +261,16 @@ def resume(script_settings='',add=False,read_only=False,step=None):
 			last_step_num = max(map(
 				lambda z:int(z),map(
 				lambda y:re.findall('^s([0-9]+)',y).pop(),filter(
-				lambda x:re.match('^s[0-9]+-\w+$',x),glob.glob('s*-*')))))
+				lambda x:re.match('^s[0-9]+-\w+$',x),project_steps(prefix='s')))))
 		except: raise Exception('[ERROR] could not find the last step')
 	else: last_step_num = step
-	last_step = filter(lambda x:re.match('^s%02d'%last_step_num,x),glob.glob('s*-*')).pop()
+	last_step = filter(lambda x:re.match('^s%02d'%last_step_num,x),project_steps(prefix='s')).pop()
 	status('[STATUS] resuming from %s'%last_step)
-	with open('script-%s.log'%last_step,'r') as fp: lines = fp.readlines()
-	regex_wordspace = '^\[CHECKPOINT\]\s+wordspace\s*=\s*(.+)'
 	try:
 		add_wordspace = {}
-		add_wordspace = json.loads(re.findall(regex_wordspace,
-			filter(lambda x:re.search(regex_wordspace,x),lines[::-1])[0])[0])
+		#---the indexed store avoids reading the log unless it is missing or disagrees with the log
+		add_wordspace = stored_wordspace(last_step,log_digest(last_step))
+		if add_wordspace == None: add_wordspace = read_checkpoint('script-%s.log'%last_step)
 		if not read_only:
 			for key,val in add_wordspace.items(): wordspace[key] = val
 	except: pass	
@@ -319,17 +358,10 @@ def continuation():
 def get_last_wordspace(step,*args):
 
 	"""
-	Retrieve the last wordspace from a previous step.
+	Retrieve keys from the last wordspace of a previous step.
+	The values come from the indexed store if it agrees with the log and from the log otherwise.
 	"""
 
-	caught = {}
-	for arg in args:
-		regex_catch = '>>>([^\s]+)'
-		cmd = 'make look step=%d'%int(re.findall('s([0-9]+)',step)[0])
-		proc = subprocess.Popen(cmd,cwd='./',shell=True,
-			stdout=subprocess.PIPE,stderr=subprocess.PIPE,stdin=subprocess.PIPE)
-		catch = '\n'.join(proc.communicate(input="print '>>>'+str(wordspace['%s'])\n"%arg))
-		values = [re.findall(regex_catch,i)[0] for i in catch.split('\n') if re.match(regex_catch,i)][0]
-		caught[arg] = values
-	import pdb;pdb.set_trace()
-	return values
\ No newline at end of file
+	oldspace = stored_wordspace(step,log_digest(step))
+	if oldspace == None: oldspace = read_checkpoint('script-%s.log'%step_name(step))
+	return dict([(arg,oldspace[arg]) for arg in args if arg in oldspace])
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+"""
+Content-addressed cache for deterministic GROMACS commands.
+
+A command is identified by a hash of the resolved command line, the standard input, the contents of every
+file it reads (including files pulled in by #include from topologies) and the GROMACS version. The files that
+a command creates or modifies in the step directory are stored under that hash so that a later run with the
+same inputs can restore them by hardlink instead of running GROMACS again.
+
+The cache is enabled by setting gmx_cache to a directory in the machine configuration. The optional keys
+gmx_cache_size (in GB) and gmx_cache_programs control eviction and which programs are cached.
+"""
+
+import os,re,json,time,shutil,hashlib,subprocess
+from amx import wordspace
+from amx.base.gromacs import machine_configuration,gmxpaths
+
+#---programs whose outputs depend only on their inputs
+gmx_cache_programs = ['grompp','editconf','pdb2gmx','genconf','make_ndx']
+
+#---default cache size in GB
+gmx_cache_size = 5.0
+
+#---version strings by program so we only ask GROMACS once
+gmx_versions = {}
+
+def gmx_cache_dir(program):
+
+	"""
+	Return the cache directory if caching is enabled for this program.
+	"""
+
+	cache_dir = machine_configuration.get('gmx_cache',None)
+	if not cache_dir: return None
+	if program not in machine_configuration.get('gmx_cache_programs',gmx_cache_programs): return None
+	return os.path.abspath(os.path.expanduser(cache_dir))
+
+def gmx_version(program):
+
+	"""
+	Return the version lines reported by a GROMACS program.
+	"""
+
+	if program not in gmx_versions:
+		out = ' '.join(subprocess.Popen(gmxpaths[program]+' -version',shell=True,executable='/bin/bash',
+			stdout=subprocess.PIPE,stderr=subprocess.PIPE).communicate())
+		gmx_versions[program] = '\n'.join(sorted(set(re.findall('(?i).*version.*',out))))
+	return gmx_versions[program]
+
+def file_digest(fn):
+
+	"""
+	SHA1 hash of the contents of a file.
+	"""
+
+	digest = hashlib.sha1()
+	with open(fn,'rb') as fp:
+		for block in iter(lambda:fp.read(1<<20),''): digest.update(block)
+	return digest.hexdigest()
+
+def input_closure(inputs):
+
+	"""
+	Expand a list of input files with every file reached through #include statements in topologies.
+	Includes are resolved relative to the including file and missing files are skipped since they are usually
+	found in the GROMACS library, which is covered by the version.
+	"""
+
+	found,pending = [],list(inputs)
+	while pending:
+		fn = os.path.normpath(pending.pop(0))
+		if fn in found: continue
+		found.append(fn)
+		path = os.path.join(wordspace['step'],fn)
+		if not re.search('\.(top|itp)$',fn) or not os.path.isfile(path): continue
+		with open(path) as fp:
+			for include in re.findall('^\s*#include\s+"([^"]+)"',fp.read(),re.M):
+				candidate = os.path.join(os.path.dirname(fn),include)
+				if os.path.isfile(os.path.join(wordspace['step'],candidate)): pending.append(candidate)
+	return found
+
+def gmx_cache_key(program,cmd,inpipe,inputs):
+
+	"""
+	Hash a command with its inputs and the GROMACS version.
+	"""
+
+	digest = hashlib.sha1()
+	for item in [program,cmd,str(inpipe),gmx_version(program)]: digest.update(item+'\0')
+	for fn in sorted(input_closure(inputs)):
+		path = os.path.join(wordspace['step'],fn)
+		digest.update(fn+'\0'+(file_digest(path) if os.path.isfile(path) else 'missing')+'\0')
+	return digest.hexdigest()
+
+def step_snapshot():
+
+	"""
+	Modification times and sizes of the files in the step directory.
+	"""
+
+	snapshot = {}
+	for fn in os.listdir(wordspace['step']):
+		path = os.path.join(wordspace['step'],fn)
+		if os.path.isfile(path):
+			stat = os.stat(path)
+			snapshot[fn] = (stat.st_mtime,stat.st_size)
+	return snapshot
+
+def link_or_copy(source,dest):
+
+	"""
+	Hardlink a file or copy it if the link is impossible (for example across filesystems).
+	"""
+
+	if os.path.lexists(dest): os.remove(dest)
+	try: os.link(source,dest)
+	except OSError: shutil.copy2(source,dest)
+
+def gmx_cache_discard(entry):
+
+	"""
+	Remove an entry without exposing a partly deleted entry to other processes.
+	The entry is renamed out of the way first so that readers either see all of it or none of it.
+	"""
+
+	trash = entry+'.trash%d'%os.getpid()
+	try: os.rename(entry,trash)
+	except OSError: return
+	shutil.rmtree(trash,ignore_errors=True)
+
+def gmx_cache_restore(cache_dir,key):
+
+	"""
+	Restore the outputs for a key into the step directory and return True on a hit.
+	Entries whose files no longer match their recorded hashes are discarded.
+	"""
+
+	entry = os.path.join(cache_dir,key[:2],key)
+	manifest_fn = os.path.join(entry,'manifest.json')
+	#---another member may discard the entry while we read it in which case we simply run the command
+	try:
+		if not os.path.isfile(manifest_fn): return False
+		with open(manifest_fn) as fp: manifest = json.load(fp)
+		for fn,digest in manifest['files'].items():
+			if not os.path.isfile(os.path.join(entry,fn)) or file_digest(os.path.join(entry,fn))!=digest:
+				gmx_cache_discard(entry)
+				return False
+		for fn in manifest['files']: link_or_copy(os.path.join(entry,fn),os.path.join(wordspace['step'],fn))
+		#---the manifest time marks recent use for eviction
+		os.utime(manifest_fn,None)
+	except (OSError,IOError): return False
+	except (ValueError,KeyError):
+		gmx_cache_discard(entry)
+		return False
+	return True
+
+def gmx_cache_store(cache_dir,key,before,cmd):
+
+	"""
+	Store the files that a command created or modified in the step directory.
+	"""
+
+	after = step_snapshot()
+	changed = [fn for fn in after if fn not in before or before[fn]!=after[fn]]
+	#---ignore the backups that GROMACS makes when it overwrites a file and the bash log
+	bash_log = os.path.abspath(wordspace.get('bash_log',''))
+	changed = [fn for fn in changed if not re.match('^#.+#$',fn) 
+		and os.path.abspath(os.path.join(wordspace['step'],fn))!=bash_log]
+	entry = os.path.join(cache_dir,key[:2],key)
+	staging = entry+'.tmp%d'%os.getpid()
+	if os.path.isdir(staging): shutil.rmtree(staging)
+	os.makedirs(staging)
+	manifest = {'cmd':cmd,'created':time.time(),'files':{}}
+	for fn in changed:
+		#---copy instead of linking so that later edits in the step directory never reach the cache
+		shutil.copy2(os.path.join(wordspace['step'],fn),os.path.join(staging,fn))
+		manifest['files'][fn] = file_digest(os.path.join(staging,fn))
+	with open(os.path.join(staging,'manifest.json'),'w') as fp: json.dump(manifest,fp)
+	#---an entry stored by another process in the meantime holds the same outputs so we keep it
+	if os.path.isdir(entry): shutil.rmtree(staging,ignore_errors=True)
+	else:
+		try: os.rename(staging,entry)
+		except OSError: shutil.rmtree(staging,ignore_errors=True)
+	gmx_cache_evict(cache_dir)
+
+def gmx_cache_evict(cache_dir):
+
+	"""
+	Remove the least recently used entries until the cache fits in gmx_cache_size.
+	"""
+
+	limit = float(machine_configuration.get('gmx_cache_size',gmx_cache_size))*1024**3
+	entries = []
+	for prefix in os.listdir(cache_dir):
+		if not os.path.isdir(os.path.join(cache_dir,prefix)): continue
+		for key in os.listdir(os.path.join(cache_dir,prefix)):
+			#---skip entries that other processes are staging or discarding
+			if '.' in key: continue
+			entry = os.path.join(cache_dir,prefix,key)
+			manifest_fn = os.path.join(entry,'manifest.json')
+			try:
+				size = sum([os.path.getsize(os.path.join(entry,fn)) for fn in os.listdir(entry)])
+				entries.append((os.path.getmtime(manifest_fn),size,entry))
+			except OSError: continue
+	total = sum([i[1] for i in entries])
+	for used,size,entry in sorted(entries):
+		if total<=limit: break
+		gmx_cache_discard(entry)
+		total -= size
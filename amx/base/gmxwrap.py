@@ -4,7 +4,10 @@ from amx import wordspace
 from amx.base.gromacs import *
 from amx.base.journal import *
 from amx.base.tools import *
-import os,shutil,re,subprocess,json,glob
+from amx.base.gmxcache import gmx_cache_dir,gmx_cache_key,gmx_cache_restore,gmx_cache_store,step_snapshot
+from amx.base.store import store_checkpoint,store_name,last_part,checkpoint_digest
+from amx.base.manifest import update_manifest
+import os,shutil,re,subprocess,json,glob,time,signal,select,sqlite3
 from amx.base.tools import ready_to_continue
 
 #---FUNCTIONS
@@ -19,11 +22,25 @@ def queue():
 	
 	wordspace['queue'] = True
 
+def gmx_progress(line):
+
+	"""
+	Return a dictionary describing progress if a line of output reports the step or the performance.
+	"""
+
+	match = gmx_progress_regex.search(line)
+	if not match: return None
+	if match.group(1)!=None: return {'step':int(match.group(1))}
+	return {'ns/day':float(match.group(2)),'hour/ns':float(match.group(3))}
+
 @narrate
-def gmx_run(cmd,log,skip=False,inpipe=None):
+def gmx_run(cmd,log,skip=False,inpipe=None,progress=None):
 
 	"""
 	Run a GROMACS command instantly and log the results to a file.
+	Output is written to the log as it arrives and each line is checked for errors so that a fatal error stops
+	the whole process group right away instead of waiting for the command to exit. The progress function, if
+	any, receives a dictionary with the step or the performance (ns/day) whenever a line reports it.
 	"""
 
 	if log == None: raise Exception('[ERROR] gmx_run needs a log file to route output')
@@ -32,21 +49,60 @@ def gmx_run(cmd,log,skip=False,inpipe=None):
 	else: raise Exception('missing log from wordspace')
 	output = open(wordspace['step']+'log-'+log,'w')
 	os.chmod(wordspace['step']+'log-'+log,0o664)
-	if inpipe == None:
-		proc = subprocess.Popen(cmd,cwd=wordspace['step'],shell=True,executable='/bin/bash',
-			stdout=output,stderr=output)
-		proc.communicate()
-	else:
-		proc = subprocess.Popen(cmd,cwd=wordspace['step'],shell=True,executable='/bin/bash',
-			stdout=output,stderr=output,stdin=subprocess.PIPE)
-		proc.communicate(input=inpipe)
+	#---run in a new process group so that we can stop everything the shell starts
+	proc = subprocess.Popen(cmd,cwd=wordspace['step'],shell=True,executable='/bin/bash',
+		stdout=subprocess.PIPE,stderr=subprocess.STDOUT,preexec_fn=os.setsid,
+		stdin=subprocess.PIPE if inpipe != None else None)
+	if inpipe != None:
+		proc.stdin.write(inpipe)
+		proc.stdin.close()
+	errors,partial,abort_time = [],'',None
+	while True:
+		#---after a fatal error we keep the explanation that follows for a moment and then stop the group
+		if abort_time and time.time()>abort_time:
+			try: os.killpg(proc.pid,signal.SIGTERM)
+			except OSError: pass
+			break
+		if not select.select([proc.stdout],[],[],0.5)[0]: continue
+		chunk = os.read(proc.stdout.fileno(),4096)
+		if not chunk: break
+		output.write(chunk)
+		output.flush()
+		#---mdrun -v rewrites the progress line with carriage returns so we split on those too
+		lines = re.split('\r|\n',partial+chunk)
+		partial = lines.pop()
+		for line in lines:
+			match = gmx_error_regex.search(line)
+			if match and match.group(1) not in errors: errors.append(match.group(1))
+			if progress:
+				state = gmx_progress(line)
+				if state: progress(state)
+		if errors and not skip and not abort_time: abort_time = time.time()+gmx_abort_delay
+	match = gmx_error_regex.search(partial)
+	if match and match.group(1) not in errors: errors.append(match.group(1))
+	proc.stdout.close()
+	proc.wait()
+	output.close()
 	#---check for errors
-	with open(wordspace['step']+'log-'+log,'r') as logfile:
-		for line in logfile:
-			for msg in gmx_error_strings:
-				if re.search(msg,line)!=None: 
-					if skip: report('[NOTE] command failed but nevermind')
-					else: raise Exception('[ERROR] %s in log-%s'%(msg.strip(':'),log))
+	for msg in errors:
+		if skip: report('[NOTE] command failed but nevermind')
+		else: raise Exception('[ERROR] %s in log-%s'%(msg.strip(':'),log))
+	return errors
+
+def command_files(program,flags):
+
+	"""
+	Sort the files named in (flag,value) pairs of a GROMACS command into inputs and outputs.
+	"""
+
+	outputs_flags = gmx_output_flags.get(program,gmx_output_flags['default'])
+	inputs,outputs = [],[]
+	for flag,value in flags:
+		for fn in value.split():
+			#---only values that look like file names are tracked
+			if not re.match('^[^-][^\s]*\.\w+$',fn) or re.match('^[-+]?[0-9.]+$',fn): continue
+			(outputs if flag in outputs_flags else inputs).append(os.path.normpath(fn))
+	return inputs,outputs
 
 @narrate
 def gmx(program ,**kwargs):
@@ -66,6 +122,12 @@ def gmx(program ,**kwargs):
 		assert 'base' in kwargs
 		skip = kwargs.pop('skip')	
 	else: skip = False	
+	#---progress receives the step and performance reported by the command as it runs
+	progress = kwargs.pop('progress') if 'progress' in kwargs else None
+	#---input files which the command does not name (e.g. through an MDP) are added to the cache key
+	declared_inputs = kwargs.pop('inputs') if 'inputs' in kwargs else []
+	#---deterministic commands are restored from the result cache unless cache is False
+	use_cache = kwargs.pop('cache') if 'cache' in kwargs else True
 	cmd = gmxpaths[program]+' '
 	#---check extra_flags for automatic overrides in the flag string
 	if extra_flags != None:
@@ -73,18 +135,35 @@ def gmx(program ,**kwargs):
 			if re.search(key+' ',extra_flags)]
 	else: override_keys = []
 	#---iterate over each item in the command library entry for a particular gromacs program
+	flags = []
 	for flag,rule in wordspace['command_library'][program].items():
 		value = str(rule)
 		for key in kwargs: value = re.sub(key.upper(),kwargs[key],value)
 		value = re.sub('NONE','',value)
-		if flag not in override_keys: cmd += flag+' '+value+' '
-	if extra_flags != None: cmd += extra_flags
+		if flag not in override_keys: 
+			cmd += flag+' '+value+' '
+			flags.append((flag,value))
+	if extra_flags != None: 
+		cmd += extra_flags
+		flags.extend(re.findall('(-\w+)\s+([^-\s][^\s]*)',extra_flags))
 	#---! correctly handled below?
 	if 'queue' in wordspace and wordspace['queue']:
 		if log != None: cmd += ' &> %s'%log
 		if 'command_queue' not in wordspace: wordspace['command_queue'] = []
 		wordspace['command_queue'].append(cmd)
-	else: gmx_run(cmd,log=log,skip=skip,inpipe=inpipe)
+	else:
+		cache_dir = gmx_cache_dir(program) if use_cache and log != None else None
+		if not cache_dir: 
+			gmx_run(cmd,log=log,skip=skip,inpipe=inpipe,progress=progress)
+			return
+		key = gmx_cache_key(program,cmd,inpipe,command_files(program,flags)[0]+list(declared_inputs))
+		if gmx_cache_restore(cache_dir,key):
+			with open(wordspace['bash_log'],'a') as fp: fp.write(cmd+' &> log-'+log+'\n')
+			report('restored %s from the cache (%s)'%(program,key[:12]),tag='status')
+			return
+		before = step_snapshot()
+		if not gmx_run(cmd,log=log,skip=skip,inpipe=inpipe,progress=progress):
+			gmx_cache_store(cache_dir,key,before,cmd)
 
 @narrate
 def gmxscript(script_file):
@@ -122,11 +201,22 @@ def bash(command,log=None,cwd=None,inpipe=None):
 		if not inpipe: proc.communicate()
 		else: proc.communicate(input=inpipe)
 
+#---write the whole wordspace at every nth checkpoint and only the changed keys in between
+checkpoint_snapshot_interval = 10
+
+#---the wordspace as of the last checkpoint in the current log (each value is stored as JSON)
+checkpoint_state = {'watch_file':None,'keys':{},'count':0,'store_full':False}
+
 @narrate
 def checkpoint():
 
 	"""
 	At the end of a GROMACS procedure, write the wordspace to the log file started by the logger.
+	The first checkpoint in each log (and every checkpoint_snapshot_interval after that) is a full snapshot in 
+	the original "wordspace = " format. The others are deltas which list the keys that changed since the last
+	checkpoint and the keys that were removed. Use read_checkpoint to rebuild the wordspace from the log.
+	The same changes are written to the indexed store in the project root (see amx.base.store) unless the
+	wordspace_store setting is False.
 	"""
 
 	#---do not try to save modules if they are imported
@@ -136,8 +226,35 @@ def checkpoint():
 	for root,dirnames,filenames in os.walk(wordspace['step']): break
 	useless_files = [i for i in filenames if re.match('^\#?step',i)]
 	for fn in useless_files: os.remove(root+'/'+fn)
-	with open(wordspace['watch_file'],'a') as fp:
-		report('wordspace = '+json.dumps(wordspace),tag='checkpoint')
+	update_manifest(wordspace['step'])
+	keys = dict([(key,json.dumps(val)) for key,val in wordspace.items()])
+	full = (checkpoint_state['watch_file']!=wordspace['watch_file'] or 
+		checkpoint_state['count']%checkpoint_snapshot_interval==0)
+	if full:
+		text = 'wordspace = '+json.dumps(wordspace)
+		checkpoint_state.update(watch_file=wordspace['watch_file'],count=0)
+		changed,unset = keys,[]
+	else:
+		changed = dict([(key,val) for key,val in keys.items() if val!=checkpoint_state['keys'].get(key)])
+		unset = [key for key in checkpoint_state['keys'] if key not in keys]
+		delta = {'set':dict([(key,wordspace[key]) for key in changed]),'unset':unset}
+		text = 'delta = '+json.dumps(delta)
+	report(text,tag='checkpoint')
+	#---the indexed store is a convenience so a failure falls back to the log and forces a full snapshot
+	#---a checkpoint that skips the store also forces a full snapshot since the next delta would miss it
+	if not wordspace.get('wordspace_store',True): checkpoint_state['store_full'] = True
+	else:
+		store_full = full or checkpoint_state['store_full']
+		try: 
+			store_checkpoint(wordspace['step'],last_part(filenames),keys if store_full else changed,
+				[] if store_full else unset,full=store_full,digest=checkpoint_digest(text))
+			checkpoint_state['store_full'] = False
+		except sqlite3.Error as e:
+			report('could not write the checkpoint to %s: %s'%(store_name,str(e)),tag='warning')
+			checkpoint_state['store_full'] = True
+	checkpoint_state['keys'] = keys
+	checkpoint_state['count'] += 1
+	flush_journal()
 
 def init(setting_string,proceed=False):
 
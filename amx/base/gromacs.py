@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
-import os,subprocess,re
+import os,subprocess,re,json,hashlib,socket
+from distutils.spawn import find_executable
 
 #---CONSTANTS
 #-------------------------------------------------------------------------------------------------------------
@@ -12,6 +13,27 @@ gmx_error_strings = [
 	'Fatal Error:',
 	'Can not open file:',
 	]
+
+#---single alternation so each line of output is scanned once for every error string
+gmx_error_regex = re.compile('(%s)'%'|'.join(gmx_error_strings))
+
+#---seconds to keep reading the output after a fatal error before stopping the command
+gmx_abort_delay = 2.0
+
+#---progress reported by mdrun -v and the performance summary at the end of the log
+gmx_progress_regex = re.compile('step\s+([0-9]+)|^Performance:\s+([0-9.]+)\s+([0-9.]+)')
+
+#---flags which name output files for each program (all other files are treated as inputs)
+gmx_output_flags = {
+	'default':['-o'],
+	'pdb2gmx':['-o','-p','-i'],
+	'grompp':['-o','-po','-pp'],
+	'mdrun':['-o','-x','-c','-e','-g','-cpo'],
+	'make_ndx':['-o'],
+	'genion':['-o'],
+	'trjconv':['-o'],
+	'tpbconv':['-o'],
+	}
 	
 gmx4paths = {
 	'grompp':'grompp',
@@ -42,10 +64,27 @@ gmx5paths = {
 	'gmxcheck':'gmx check',
 	'vmd':'vmd',
 	}
+
+#---detected GROMACS paths and module environments keyed by machine, configuration and PATH
+gmxpaths_cache_file = os.path.join(os.path.expanduser('~'),'.automacs-gmxpaths.json')
+
+#---fastest mdrun flags found by the tuner (see amx/base/tuner.py) keyed by host, machine and nprocs
+mdrun_tuning_file = os.path.join(os.path.expanduser('~'),'.automacs-mdrun.json')
 	
 #---SETTINGS
 #-------------------------------------------------------------------------------------------------------------
 
+def machine_config_file():
+
+	"""
+	Return the configuration file which is either local or in the home directory.
+	"""
+
+	#---look upwards if making docs so no tracebacks
+	prefix = '../../../' if re.match('.+\/docs\/build$',os.getcwd()) else ''
+	if os.path.isfile(prefix+'./config.py'): return prefix+'./config.py'
+	else: return os.environ['HOME']+'/.automacs.py'
+
 def prepare_machine_configuration(hostname=None):
 
 	"""
@@ -54,10 +93,7 @@ def prepare_machine_configuration(hostname=None):
 
 	#---load configuration
 	config_raw = {}
-	#---look upwards if making docs so no tracebacks
-	prefix = '../../../' if re.match('.+\/docs\/build$',os.getcwd()) else ''
-	if os.path.isfile(prefix+'./config.py'): execfile(prefix+'./config.py',config_raw)
-	else: execfile(os.environ['HOME']+'/.automacs.py',config_raw)
+	execfile(machine_config_file(),config_raw)
 	machine_configuration = config_raw['machine_configuration']
 
 	#---select a machine configuration
@@ -77,8 +113,50 @@ def prepare_machine_configuration(hostname=None):
 	if ('nnodes' in machine_configuration and 'ppn' in machine_configuration 
 		and not 'nprocs' in machine_configuration):
 		machine_configuration['nprocs'] = machine_configuration['nnodes']*machine_configuration['ppn']
+	#---tuned mdrun flags apply unless the configuration sets its own
+	if 'mdrun_flags' not in machine_configuration and 'mdrun_command' not in machine_configuration:
+		tuned = read_mdrun_tuning(machine_configuration,this_machine)
+		if tuned: 
+			print '[STATUS] using tuned mdrun flags: %s'%tuned['flags']
+			machine_configuration['mdrun_flags'] = str(tuned['flags'])
 	return machine_configuration,this_machine
 
+def mdrun_tuning_key(machine_configuration,this_machine):
+
+	"""
+	Tuned flags are specific to a host, a machine configuration and the number of threads mdrun may use.
+	"""
+
+	nprocs = machine_configuration.get('nprocs',None)
+	if not nprocs: 
+		import multiprocessing
+		nprocs = multiprocessing.cpu_count()
+	return '%s %s %d'%(socket.gethostname(),this_machine,int(nprocs))
+
+def read_mdrun_tuning(machine_configuration,this_machine):
+
+	"""
+	Return the tuned mdrun configuration for this machine or None if it was never tuned.
+	"""
+
+	try:
+		with open(mdrun_tuning_file) as fp: tuning = json.load(fp)
+	except (IOError,ValueError): return None
+	return tuning.get(mdrun_tuning_key(machine_configuration,this_machine),None)
+
+def write_mdrun_tuning(machine_configuration,this_machine,entry):
+
+	"""
+	Record the tuned mdrun configuration for this machine.
+	"""
+
+	try:
+		with open(mdrun_tuning_file) as fp: tuning = json.load(fp)
+	except (IOError,ValueError): tuning = {}
+	tuning[mdrun_tuning_key(machine_configuration,this_machine)] = entry
+	with open(mdrun_tuning_file+'.tmp%d'%os.getpid(),'w') as fp: json.dump(tuning,fp,indent=1)
+	os.rename(mdrun_tuning_file+'.tmp%d'%os.getpid(),mdrun_tuning_file)
+
 def prepare_gmxpaths(machine_configuration,override=False,gmx_series=False):
 
 	"""
@@ -113,7 +191,9 @@ def prepare_gmxpaths(machine_configuration,override=False,gmx_series=False):
 			for key,val in gmxpaths.items():
 				gmxpaths[key] = re.sub('gmx ','gmx%s '%suffix,val)
 		else: gmxpaths = dict([(key,val+suffix) for key,val in gmxpaths.items()])
-	if 'nprocs' in config and config['nprocs'] != None: gmxpaths['mdrun'] += ' -nt %d'%config['nprocs']
+	#---mdrun_flags (set in the configuration or by the tuner) choose the threads instead of nprocs
+	if 'mdrun_flags' in config: gmxpaths['mdrun'] += ' '+config['mdrun_flags']
+	elif 'nprocs' in config and config['nprocs'] != None: gmxpaths['mdrun'] += ' -nt %d'%config['nprocs']
 	#---use mdrun_command for quirky mpi-type mdrun calls on clusters
 	if 'mdrun_command' in machine_configuration: gmxpaths['mdrun'] = machine_configuration['mdrun_command']
 	#---if any utilities are keys in config we override and then perform uppercase substitutions from config
@@ -127,28 +207,108 @@ def prepare_gmxpaths(machine_configuration,override=False,gmx_series=False):
 	if 'gpu_flag' in config: gmxpaths['mdrun'] += ' -nb %s'%config['gpu_flag']	
 	return gmxpaths
 
-#---load machine configuration and gmxpaths into globals
+def load_modules(machine_configuration,this_machine):
+
+	"""
+	Load environment modules from python to setup GROMACS if necessary/desired.
+	Returns the environment variables that changed (None for removed variables) so they can be cached.
+	"""
+
+	environment = dict(os.environ)
+	try:
+		#---modules in LOCAL configuration must be loaded before checking version
+		module_path = '/usr/share/Modules/default/init/python.py'
+		if 'modules' in machine_configuration:
+			print '[STATUS] found modules in %s configuration'%this_machine
+			if 'module_path' in machine_configuration: module_path = machine_configuration['module_path']
+			module_globals = {}
+			execfile(module_path,module_globals)
+			module = module_globals['module']
+			print '[STATUS] unloading GROMACS'
+			#---note that modules that rely on dynamically-linked C-code must use EnvironmentModules
+			modlist = machine_configuration['modules']
+			if type(modlist)==str: modlist = modlist.split(',')
+			for mod in modlist:
+				#---always unload gromacs to ensure correct version
+				module('unload','gromacs')
+				print '[STATUS] module load %s'%mod
+				module('load',mod)
+	except: print '[STATUS] failed to use importlib to load modules'
+	changes = dict([(key,val) for key,val in os.environ.items() if environment.get(key,None)!=val])
+	changes.update(dict([(key,None) for key in environment if key not in os.environ]))
+	return changes
+
+def gmxpaths_key(machine_configuration,this_machine):
+
+	"""
+	Identify a GROMACS setup by the host, the configuration, the PATH and the executables found on it.
+	"""
+
+	suffix = machine_configuration.get('suffix','')
+	digest = hashlib.sha1()
+	with open(machine_config_file()) as fp: config_text = fp.read()
+	for item in [socket.gethostname(),this_machine,config_text,os.environ.get('PATH',''),
+		machine_configuration.get('mdrun_flags','')]:
+		digest.update(item+'\0')
+	for name in ['gmx%s'%suffix,'mdrun%s'%suffix]:
+		path = find_executable(name)
+		digest.update('%s %s\0'%(path,os.path.getmtime(path) if path else None))
+	return digest.hexdigest()
+
+class GMXPaths(dict):
+
+	"""
+	Paths to the GROMACS executables which are only detected the first time they are used.
+	Detection loads environment modules and probes GROMACS so we cache the result and the module environment
+	in gmxpaths_cache_file and reuse them while the host, configuration and executables are unchanged.
+	"""
+
+	def __init__(self,machine_configuration,this_machine):
+
+		dict.__init__(self)
+		self.machine_configuration,self.this_machine = machine_configuration,this_machine
+		self.ready = False
+
+	def prepare(self):
+
+		"""
+		Fill in the paths from the cache or by probing GROMACS.
+		"""
+
+		if self.ready: return self
+		key = gmxpaths_key(self.machine_configuration,self.this_machine)
+		try:
+			with open(gmxpaths_cache_file) as fp: cache = json.load(fp)
+		except (IOError,ValueError): cache = {}
+		if key in cache:
+			for name,val in cache[key]['environment'].items():
+				if val==None: os.environ.pop(name,None)
+				else: os.environ[str(name)] = str(val)
+			dict.update(self,[(str(k),str(v)) for k,v in cache[key]['gmxpaths'].items()])
+		else:
+			environment = load_modules(self.machine_configuration,self.this_machine)
+			paths = prepare_gmxpaths(self.machine_configuration)
+			dict.update(self,paths)
+			cache[key] = {'environment':environment,'gmxpaths':paths}
+			#---write to a temporary file and move it into place since several jobs may share a home
+			try:
+				with open(gmxpaths_cache_file+'.tmp%d'%os.getpid(),'w') as fp: json.dump(cache,fp)
+				os.rename(gmxpaths_cache_file+'.tmp%d'%os.getpid(),gmxpaths_cache_file)
+			except (IOError,OSError): pass
+		self.ready = True
+		return self
+
+	def __getitem__(self,key): return dict.__getitem__(self.prepare(),key)
+	def __contains__(self,key): return dict.__contains__(self.prepare(),key)
+	def __iter__(self): return dict.__iter__(self.prepare())
+	def __len__(self): return dict.__len__(self.prepare())
+	def __repr__(self): return dict.__repr__(self.prepare())
+	def get(self,key,default=None): return dict.get(self.prepare(),key,default)
+	def keys(self): return dict.keys(self.prepare())
+	def values(self): return dict.values(self.prepare())
+	def items(self): return dict.items(self.prepare())
+	def copy(self): return dict(self.items())
+
+#---load machine configuration into globals and detect GROMACS the first time we need it
 machine_configuration,this_machine = prepare_machine_configuration()
-#---load environment modules from python to setup GROMACS if necessary/desired
-try:
-	#---modules in LOCAL configuration must be loaded before checking version
-	module_path = '/usr/share/Modules/default/init/python.py'
-	if 'modules' in machine_configuration:
-		import importlib
-		print '[STATUS] found modules in %s configuration'%this_machine
-		if 'module_path' in machine_configuration: module_path = machine_configuration['module_path']
-		execfile(module_path)
-		#try: execfile(module_path)
-		#except: raise Exception('could not execute %s'%module_path)
-		print '[STATUS] unloading GROMACS'
-		#---note that modules that rely on dynamically-linked C-code must use EnvironmentModules
-		modlist = machine_configuration['modules']
-		if type(modlist)==str: modlist = modlist.split(',')
-		for mod in modlist:
-			#---always unload gromacs to ensure correct version
-			module('unload','gromacs')
-			print '[STATUS] module load %s'%mod
-			module('load',mod)
-		del mod
-except: print '[STATUS] failed to use importlib to load modules'
-gmxpaths = prepare_gmxpaths(machine_configuration)
+gmxpaths = GMXPaths(machine_configuration,this_machine)
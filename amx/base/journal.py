@@ -1,12 +1,94 @@
 #!/usr/bin/python
 
 from amx import wordspace
-import os,sys
+import os,sys,time,atexit,threading
 from functools import wraps
 
 #---always print to stdout without a buffer
 unbuffered = os.fdopen(sys.stdout.fileno(),'w',0)
 
+#---journal messages are written when the buffer holds this many bytes or after this many seconds
+journal_buffer_size = 65536
+journal_flush_interval = 1.0
+#---a background thread flushes the journal on the interval even if nothing else is reported
+journal_background = True
+
+class Journal:
+
+	"""
+	Buffered writer for the watch file.
+	Opening and closing the log for every message is slow on network filesystems, so we keep it open and
+	write the messages in batches. The buffer is flushed when it is full, when the oldest message is older
+	than journal_flush_interval, at checkpoints, on exceptions and at exit.
+	"""
+
+	def __init__(self):
+
+		self.fn,self.fp = None,None
+		self.buffer,self.size,self.since = [],0,None
+		self.lock = threading.RLock()
+		self.thread = None
+
+	def write(self,fn,message):
+
+		with self.lock:
+			if fn!=self.fn: self.open(fn)
+			self.buffer.append(message)
+			self.size += len(message)
+			if self.since==None: self.since = time.time()
+			if self.size>=journal_buffer_size or time.time()-self.since>=journal_flush_interval: self.flush()
+		if journal_background and not self.thread: self.start()
+
+	def open(self,fn):
+
+		"""
+		Switch to a new watch file after writing everything destined for the old one.
+		"""
+
+		self.close()
+		self.fn,self.fp = fn,open(fn,'a')
+
+	def flush(self):
+
+		with self.lock:
+			if self.buffer and self.fp:
+				self.fp.write(''.join(self.buffer))
+				self.fp.flush()
+			self.buffer,self.size,self.since = [],0,None
+
+	def close(self):
+
+		with self.lock:
+			self.flush()
+			if self.fp: self.fp.close()
+			self.fn,self.fp = None,None
+
+	def start(self):
+
+		"""
+		Start a daemon thread which flushes old messages while the main thread is busy (e.g. in mdrun).
+		"""
+
+		#---bind the functions we need since module globals are cleared while daemon threads still run at exit
+		def flusher(sleep=time.sleep,clock=time.time,interval=journal_flush_interval):
+			while True:
+				sleep(interval)
+				if self.since!=None and clock()-self.since>=interval: self.flush()
+		self.thread = threading.Thread(target=flusher)
+		self.thread.daemon = True
+		self.thread.start()
+
+journal = Journal()
+atexit.register(journal.close)
+
+def flush_journal():
+
+	"""
+	Write any buffered messages to the watch file.
+	"""
+
+	journal.flush()
+
 def report(text,**kwargs):
 
 	"""
@@ -18,7 +100,7 @@ def report(text,**kwargs):
 	newline_trail = kwargs.get('newline_trail',False)
 	watch_file = kwargs.get('watch_file',None)
 	message = ('\n' if newline else '')+'[%s] %s'%(tag.upper(),text)+('\n' if newline_trail else '')
-	with open(wordspace['watch_file'],'a') as fp: fp.write(message+'\n')
+	journal.write(wordspace['watch_file'],message+'\n')
 	print(message)
 
 def status(string,i=0,looplen=None,bar_character=None,width=25,tag='',start=None):
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+"""
+Index of the steps, parts and key files in a project.
+
+Finding the last step or part used to mean listing every step folder. On projects with thousands of parts
+(often on a parallel filesystem) this is slow, and two processes could see different answers. The manifest
+in the project root records the steps along with the parts and key files (see manifest_suffixes) in each
+one. It also stores the modification time of every step folder, and a step is listed again only when that
+time changes. Folders modified in the last few seconds are always listed again, because a file added within
+the same clock tick would not change the time.
+
+The manifest is updated by start, by checkpoint and by the continuation script, which runs this file from
+the project root with the step name. It only uses the standard library so the controller can use it too.
+"""
+
+import os,re,sys,json,time
+
+#---name of the manifest in the project root
+manifest_name = 'manifest.json'
+
+#---suffixes of the files which we track for each part
+manifest_suffixes = ['cpt','tpr','gro','xtc','edr']
+
+#---step folders are a letter, a number and a name e.g. s01-bilayer
+manifest_step_regex = '^[a-z]([0-9]+)-[\w-]+$'
+
+#---folders modified more recently than this (in seconds) are never trusted
+manifest_racy_window = 2.0
+
+#---the last manifest read by this process with the modification time of its file
+manifest_state = {}
+
+def manifest_path(root='./'):
+
+	"""
+	Location of the manifest for a project.
+	"""
+
+	return os.path.join(os.path.abspath(root),manifest_name)
+
+def load_manifest(root='./'):
+
+	"""
+	Read the manifest once per change to the file and return an empty one if it is missing or unreadable.
+	"""
+
+	fn = manifest_path(root)
+	try: stamp = os.path.getmtime(fn)
+	except OSError: return {'steps':{}}
+	if fn in manifest_state and manifest_state[fn][0]==stamp: return manifest_state[fn][1]
+	try:
+		with open(fn) as fp: manifest = json.load(fp)
+	except (IOError,ValueError): return {'steps':{}}
+	manifest_state[fn] = (stamp,manifest)
+	return manifest
+
+def write_manifest(manifest,root='./'):
+
+	"""
+	Write the manifest through a temporary file so that readers never see a partial one.
+	"""
+
+	fn = manifest_path(root)
+	try:
+		with open(fn+'.tmp%d'%os.getpid(),'w') as fp: json.dump(manifest,fp)
+		os.rename(fn+'.tmp%d'%os.getpid(),fn)
+		manifest_state[fn] = (os.path.getmtime(fn),manifest)
+	#---a read-only project still works since every lookup can fall back to listing the folders
+	except (IOError,OSError): pass
+
+def scan_step(path):
+
+	"""
+	List the parts and key files in a step folder.
+	The modification time is read before listing so that changes during the listing make the entry stale.
+	"""
+
+	stamp = os.path.getmtime(path)
+	if time.time()-stamp<manifest_racy_window: stamp = None
+	parts,files = {},[]
+	regex_part = '^md\.part([0-9]{4})\.(%s)$'%'|'.join(manifest_suffixes)
+	for fn in os.listdir(path):
+		match = re.match(regex_part,fn)
+		if match: parts.setdefault(match.group(1),[]).append(match.group(2))
+		elif os.path.splitext(fn)[1][1:] in manifest_suffixes: files.append(fn)
+	return {'stamp':stamp,'parts':dict([(k,sorted(v)) for k,v in parts.items()]),'files':sorted(files)}
+
+def step_entry(manifest,name,root='./',force=False):
+
+	"""
+	Return the manifest entry for a step after listing the folder again if it changed.
+	Returns True as the second value if the entry was updated.
+	"""
+
+	path = os.path.join(root,name)
+	entry = manifest['steps'].get(name,None)
+	if not force and entry and entry['stamp']!=None and entry['stamp']==os.path.getmtime(path):
+		return entry,False
+	entry = scan_step(path)
+	manifest['steps'][name] = entry
+	return entry,True
+
+def project_manifest(root='./'):
+
+	"""
+	Return the manifest for a project with every stale step listed again.
+	Only the project root is listed every time, which is cheap compared to the step folders.
+	"""
+
+	manifest = load_manifest(root)
+	names = [i for i in os.listdir(root) if re.match(manifest_step_regex,i)
+		and os.path.isdir(os.path.join(root,i))]
+	changed = any([i not in names for i in manifest['steps']])
+	manifest['steps'] = dict([(k,v) for k,v in manifest['steps'].items() if k in names])
+	for name in names: changed = step_entry(manifest,name,root=root)[1] or changed
+	if changed: write_manifest(manifest,root=root)
+	return manifest
+
+def update_manifest(step,root='./'):
+
+	"""
+	List one step folder again and record it in the manifest.
+	"""
+
+	name = os.path.basename(os.path.normpath(step))
+	manifest = load_manifest(root)
+	entry = step_entry(manifest,name,root=root,force=True)[0]
+	write_manifest(manifest,root=root)
+	return entry
+
+def project_steps(prefix='[a-z]',root='./'):
+
+	"""
+	Sorted names of the step folders with a given prefix.
+	"""
+
+	return sorted([i for i in project_manifest(root)['steps'] if re.match('^%s[0-9]+-'%prefix,i)])
+
+def step_parts(step,suffix='cpt',root='./'):
+
+	"""
+	Sorted part numbers in a step which have a file with the given suffix.
+	Suffixes and folders which the manifest does not track are found by listing the folder.
+	"""
+
+	name = os.path.basename(os.path.normpath(step))
+	if suffix not in manifest_suffixes or not re.match(manifest_step_regex,name):
+		return sorted([int(i) for fn in os.listdir(os.path.join(root,step))
+			for i in re.findall('^md\.part([0-9]{4})\.%s$'%re.escape(suffix),fn)])
+	manifest = load_manifest(root)
+	entry,changed = step_entry(manifest,name,root=root)
+	if changed: write_manifest(manifest,root=root)
+	return sorted([int(k) for k,v in entry['parts'].items() if suffix in v])
+
+if __name__ == '__main__':
+
+	#---the continuation script records each new part with: python amx/base/manifest.py <step>
+	for step in sys.argv[1:]: update_manifest(step)
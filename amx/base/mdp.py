@@ -1,12 +1,147 @@
 #!/usr/bin/python
 
-import re
+import os,re
 from copy import deepcopy
 from amx import wordspace
 from amx.base.journal import *
 
+#---parameter files by absolute path with their modification times, mdpdefs and compiled groups
+mdp_cache = {}
+
 def delve(o,*k): return delve(o[k[0]],*k[1:]) if len(k)>1 else o[k[0]]
 
+def mdp_parameter_file(param_file=None):
+
+	"""
+	Choose the parameters from the inputs folder if available, otherwise from amx/procedures.
+	"""
+
+	if param_file: return param_file
+	custom_mdp_parameters = 'inputs/parameters.py'
+	if os.path.isfile(custom_mdp_parameters):
+		report('found custom parameters.py in inputs',tag='status')
+		return custom_mdp_parameters
+	report('using amx/procedures/parameters.py for mdp parameters',tag='status')
+	return 'amx/procedures/parameters.py'
+
+def load_mdpdefs(param_file):
+
+	"""
+	Execute a parameter file once for each modification and return its cache entry.
+	"""
+
+	path = os.path.abspath(param_file)
+	stamp = os.path.getmtime(path)
+	if path not in mdp_cache or mdp_cache[path]['stamp']!=stamp:
+		mdpfile = {}
+		execfile(param_file,mdpfile)
+		if type(mdpfile.get('mdpdefs',None))!=dict:
+			raise Exception('[ERROR] %s must define a dictionary called mdpdefs'%param_file)
+		mdp_cache[path] = {'stamp':stamp,'mdpdefs':mdpfile['mdpdefs'],'groups':{}}
+	return mdp_cache[path]
+
+def compile_mdp_group(param_file,group):
+
+	"""
+	Validate the defaults for a group of parameters and index the MDP parameters in each default section.
+	"""
+
+	cached = load_mdpdefs(param_file)
+	if group not in cached['groups']:
+		if group not in cached['mdpdefs']: 
+			raise Exception('[ERROR] cannot find the MDP group "%s" in %s'%(group,param_file))
+		mdpdefs = cached['mdpdefs'][group]
+		if type(mdpdefs.get('defaults',None))!=dict:
+			raise Exception('[ERROR] the MDP group "%s" in %s needs a defaults dictionary'%(group,param_file))
+		defaults = []
+		for key,val in mdpdefs['defaults'].items():
+			try: section = mdpdefs[key] if val==None else mdpdefs[key][val]
+			except (KeyError,TypeError): section = None
+			if type(section)!=dict: 
+				raise Exception('[ERROR] the default "%s: %s" in the MDP group "%s" is not a dictionary'%
+					(key,val,group))
+			defaults.append((key,section))
+		index = {}
+		for heading,section in defaults:
+			for key in section: index.setdefault(key,[]).append(heading)
+		cached['groups'][group] = {'mdpdefs':mdpdefs,'defaults':defaults,'index':index}
+	return cached['groups'][group]
+
+def resolve_mdp(compiled,refinements):
+
+	"""
+	Apply the refinements for one MDP file to the defaults from a compiled group (see write_mdp).
+	Sections point into mdpdefs until the end so that each one is copied once regardless of the number of
+	overrides, and the index of MDP parameters is updated whenever a section is replaced.
+	"""
+
+	mdpdefs = compiled['mdpdefs']
+	settings,overrides = {},{}
+	index = dict([(key,list(val)) for key,val in compiled['index'].items()])
+	for heading,section in compiled['defaults']: settings[heading],overrides[heading] = section,{}
+	def replace(heading,section):
+		for key in settings.get(heading,{}):
+			index[key].remove(heading)
+			if not index[key]: del index[key]
+		settings[heading],overrides[heading] = section,{}
+		for key in section: index.setdefault(key,[]).append(heading)
+	for refinecode in refinements if refinements != None else []:
+		#---if the refinement code in the list given at mdpspecs[mdpname] is a string then we
+		#---...navigate to mdpdefs[refinecode] and use its children to override settings[key] 
+		if type(refinecode) in [str,unicode]:
+			for key,val in mdpdefs[refinecode].items():
+				#---if the value for an object in mdpdefs[refinecode] is a dictionary, we 
+				#---...replace settings[key] with that dictionary
+				if type(val)==dict: replace(key,val)
+				#---otherwise the value is really a lookup code and we search for a default value
+				#---...at the top level of mdpdefs where we expect mdpdefs[key][val] to be 
+				#---...a particular default value for the MDP heading given by key
+				elif type(val) in [str,unicode]: replace(key,mdpdefs[key][val])
+				else: raise Exception('unclear refinecode = '+refinecode+', '+key+', '+str(val))
+		#---if the refinement code is a dictionary, we iterate over each rule
+		else:
+			for key2,val2 in refinecode.items():
+				#---if the rule is in the top level of mdpdefs then it selects groups of settings
+				if key2 in mdpdefs: 
+					report('using MDP override collection: '+key2+': '+str(val2),tag='note')
+					replace(key2,mdpdefs[key2][val2])
+				#---if not, then we assume the rule is meant to override a native MDP parameter
+				#---...so we check to make sure it's already in settings and then we override
+				elif key2 in index:
+					report('overriding MDP parameter: '+key2+': '+str(val2),tag='note')
+					for sub in index[key2]: overrides[sub][key2] = deepcopy(val2)
+				else: 
+					#---! note that GROMACS parameters might be case-insensitive
+					raise Exception(
+						'cannot comprehend one of your overrides: "%r"="%r"'%(key2,val2)+
+						'\nnote that the settings list is: "%r"'%sorted(index.keys()))
+	#---copy each section in place so the headings keep their order
+	for heading in settings.keys():
+		subset = deepcopy(settings[heading])
+		#---assign the overrides one at a time because update can reorder the keys
+		for key,val in overrides[heading].items(): subset[key] = val
+		#---completely remove some items if they are set to -1, specifically the flags for trr files
+		for key in ['nstxout','nstvout']:
+			if key in subset and subset[key] == -1: subset.pop(key)
+		settings[heading] = subset
+	return settings
+
+def mdp_tree(param_file=None,extras=None):
+
+	"""
+	Resolve every MDP file in the mdp_specs (or extras) in one pass and return the parameters for each file
+	by heading. This is what write_mdp writes, so it can be used to inspect the parameters for a step.
+	"""
+
+	mdpspecs = wordspace['mdp_specs'] if not extras else extras
+	#--topkeys is the root node for our parameters in mdpdict
+	assert 'group' in mdpspecs
+	compiled = compile_mdp_group(mdp_parameter_file(param_file),mdpspecs['group'])
+	#---loop over each requested MDP file
+	target_mdps = [i for i in mdpspecs if re.match('.+\.mdp$',i)]
+	if not target_mdps: raise Exception('\n[ERROR] called write_mdp() but no valid mdp targets in mdp_specs')
+	return dict([(mdpname,resolve_mdp(compiled,mdpspecs[mdpname])) for mdpname in target_mdps])
+
 @narrate
 def write_mdp(param_file=None,rootdir='./',outdir='',extras=None):
 
@@ -39,80 +174,20 @@ def write_mdp(param_file=None,rootdir='./',outdir='',extras=None):
 	contain override keys and dictionaries. If you include a dictionary in the value for a particular MDP 
 	file then its key-value pairs will either override an MDP setting directly or override a key-value
 	pair in the defaults.
-	"""
 
-	mdpspecs = wordspace['mdp_specs'] if not extras else extras
-
-	if not param_file:
-		custom_mdp_parameters = 'inputs/parameters.py'
-		if os.path.isfile(custom_mdp_parameters):
-			param_file = custom_mdp_parameters
-			report('found custom parameters.py in inputs',tag='status')
-		else: 
-			param_file = 'amx/procedures/parameters.py'
-			report('using amx/procedures/parameters.py for mdp parameters',tag='status')
-
-	#---retrieve the master inputs file
-	mdpfile = {}
-	execfile(param_file,mdpfile)
-	mdpdefs = mdpfile['mdpdefs']
+	The parameter file is executed once per process (and again only if it changes) and every MDP file in the
+	specs is resolved in one pass by mdp_tree. Files whose contents have not changed are not rewritten, so 
+	their modification times stay put and the grompp calls that read them can be restored from the cache.
+	"""
 
-	#--topkeys is the root node for our parameters in mdpdict
-	assert 'group' in mdpspecs
-	mdpdefs = mdpdefs[mdpspecs['group']] if (mdpspecs and 'group' in mdpspecs) else mdpdefs
-	mdpspecs = [] if not mdpspecs else mdpspecs
-	#---loop over each requested MDP file
-	target_mdps = [i for i in mdpspecs if re.match('.+\.mdp$',i)]
-	if not target_mdps: raise Exception('\n[ERROR] called write_mdp() but no valid mdp targets in mdp_specs')
-	for mdpname in target_mdps:
-		settings = {}
-		#---run through defaults and add them to our MDP file dictionary
-		#---the defaults list contains keys that name essential sections of every MDP file
-		for key,val in mdpdefs['defaults'].items():
-			#---if default says None then we get the parameters for that from the top level
-			if val==None: settings[key] = deepcopy(mdpdefs[key])
-			else: settings[key] = deepcopy(mdpdefs[key][val])
-		#---refinements are given in the mdpspecs dictionary
-		if mdpspecs[mdpname] != None:
-			for refinecode in mdpspecs[mdpname]:
-				#---if the refinement code in the list given at mdpspecs[mdpname] is a string then we
-				#---...navigate to mdpdefs[refinecode] and use its children to override settings[key] 
-				if type(refinecode) in [str,unicode]:
-					for key,val in mdpdefs[refinecode].items():
-						#---if the value for an object in mdpdefs[refinecode] is a dictionary, we 
-						#---...replace settings[key] with that dictionary
-						if type(val)==dict: settings[key] = deepcopy(val)
-						#---otherwise the value is really a lookup code and we search for a default value
-						#---...at the top level of mdpdefs where we expect mdpdefs[key][val] to be 
-						#---...a particular default value for the MDP heading given by key
-						elif type(val) in [str,unicode]: settings[key] = deepcopy(mdpdefs[key][val])				
-						else: raise Exception('unclear refinecode = '+refinecode+', '+key+', '+str(val))
-				#---if the refinement code is a dictionary, we iterate over each rule
-				else:
-					for key2,val2 in refinecode.items():
-						settings_flat = [j for k in [settings[i].keys() for i in settings] for j in k]
-						#---if the rule is in the top level of mdpdefs then it selects groups of settings
-						if key2 in mdpdefs.keys(): 
-							report('using MDP override collection: '+key2+': '+str(val2),tag='note')
-							settings[key2] = deepcopy(mdpdefs[key2][val2])
-						#---if not, then we assume the rule is meant to override a native MDP parameter
-						#---...so we check to make sure it's already in settings and then we override
-						elif key2 in settings_flat:
-							report('overriding MDP parameter: '+key2+': '+str(val2),tag='note')
-							for sub in settings:
-								if key2 in settings[sub]: settings[sub][key2] = deepcopy(val2)
-						else: 
-							#---! note that GROMACS parameters might be case-insensitive
-							raise Exception(
-								'cannot comprehend one of your overrides: "%r"="%r"'%(key2,val2)+
-								'\nnote that the settings list is: "%r"'%settings_flat)
-		#---completely remove some items if they are set to -1, specifically the flags for trr files
-		for key in ['nstxout','nstvout']:
-			for heading,subset in settings.items():
-				if key in subset and subset[key] == -1: subset.pop(key)
-		#---always write to the step directory
-		with open(rootdir+'/'+wordspace['step']+'/'+mdpname,'w') as fp:
-			for heading,subset in settings.items():
-				fp.write('\n;---'+heading+'\n')
-				for key,val in subset.items():
-					fp.write(str(key)+' = '+str(val)+'\n')
+	for mdpname,settings in mdp_tree(param_file=param_file,extras=extras).items():
+		text = ''
+		for heading,subset in settings.items():
+			text += '\n;---'+heading+'\n'
+			for key,val in subset.items(): text += str(key)+' = '+str(val)+'\n'
+		#---always write to the step directory but leave unchanged files alone so grompp can be skipped
+		fn = rootdir+'/'+wordspace['step']+'/'+mdpname
+		if os.path.isfile(fn):
+			with open(fn) as fp: 
+				if fp.read()==text: continue
+		with open(fn,'w') as fp: fp.write(text)
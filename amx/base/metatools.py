@@ -22,6 +22,55 @@ def script_settings_replace(script,settings_string,**kwargs):
 		for key,val in strings.items(): fp.write('%s = """%s"""\n\n'%(key,val))
 		for line in lines[cutout[1]:]: fp.write(line)
 
+class LazyProcedure:
+
+	"""
+	Stand-in for a procedure function which imports its module the first time it is called.
+	"""
+
+	def __init__(self,libfile,name):
+
+		self.libfile,self.__name__ = libfile,name
+		self.function = None
+
+	def __call__(self,*args,**kwargs):
+
+		if not self.function:
+			module = __import__('amx.procedures.%s'%self.libfile,fromlist=[self.__name__])
+			self.function = getattr(module,self.__name__)
+		return self.function(*args,**kwargs)
+
+	def __repr__(self): return '<procedure %s from amx.procedures.%s>'%(self.__name__,self.libfile)
+
+def procedure_namespace(libfile):
+
+	"""
+	Collect the names that a procedure module supplies without importing it.
+	Procedures often import numpy and scipy which are slow to load, so we read the module instead and return
+	the literal values (e.g. command_library and mdp_specs) along with a LazyProcedure for each function. If
+	the module does anything else at the top level we return None and the caller imports it as usual.
+	"""
+
+	import ast
+	fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','procedures',libfile+'.py')
+	try:
+		with open(fn) as fp: tree = ast.parse(fp.read(),fn)
+	except (IOError,SyntaxError): return None
+	namespace = {}
+	for node in tree.body:
+		#---names taken from other procedures are only available after an import
+		if isinstance(node,ast.ImportFrom) and re.match('^amx\.procedures\.(?!common$|codes)',
+			node.module or '') and any([alias.name!='*' for alias in node.names]): return None
+		elif isinstance(node,(ast.Import,ast.ImportFrom)): continue
+		elif isinstance(node,ast.Expr) and isinstance(node.value,ast.Str): continue
+		elif isinstance(node,ast.FunctionDef): namespace[node.name] = LazyProcedure(libfile,node.name)
+		elif isinstance(node,ast.Assign) and all([isinstance(t,ast.Name) for t in node.targets]):
+			try: value = ast.literal_eval(node.value)
+			except ValueError: return None
+			for target in node.targets: namespace[target.id] = value
+		else: return None
+	return namespace
+
 def write_wordspace(wordspace,outfile=None):
 
 	"""
@@ -40,12 +89,13 @@ def exception_handler(e,wordspace,all=False,outfile=None):
 
 	exc_type, exc_obj, exc_tb = sys.exc_info()
 	fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-	from amx.base.journal import report
+	from amx.base.journal import report,flush_journal
 	report('%s in %s at line %d'%(str(exc_type),fname,exc_tb.tb_lineno),tag='error')
 	report('%s'%e,tag='error')
 	if all:
 		import traceback
 		report(re.sub('\n','\n[TRACEBACK] ',traceback.format_exc()),tag='traceback')
+	flush_journal()
 	write_wordspace(wordspace,outfile=outfile)
 	sys.exit(1)
 
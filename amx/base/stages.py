@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+"""
+Incremental execution of procedure stages.
+
+Procedure functions decorated with stage are recorded in stages.json in the step directory. Each record holds
+the call, the values of the wordspace keys that the stage read, fingerprints of the files in the step
+directory before the stage and the files and wordspace keys that it changed. When a script is run again,
+every stage which is still up to date is skipped by restoring its changes to the wordspace and execution
+resumes at the first stale stage. All stages after that one run normally and replace the old records.
+
+A stage is stale when its call changed, when a wordspace key or file that it used has changed since the
+last run or when one of its outputs is missing or was modified. Inputs and outputs that a later stage
+overwrites are checked by that later stage instead. Only files in the top level of the step directory are
+tracked and files larger than stage_hash_limit are compared by size and modification time alone. Set
+incremental to False in the settings to run every stage.
+"""
+
+import os,re,json,hashlib
+from functools import wraps
+from amx import wordspace,WordSpace
+from amx.base.journal import report
+
+#---name of the stage records in the step directory
+stage_record_name = 'stages.json'
+
+#---files larger than this (in bytes) are fingerprinted by size and modification time only
+stage_hash_limit = 64*1024**2
+
+#---bookkeeping keys which never invalidate a stage
+stage_ignore_keys = ['function_history','under_development','wordspace_location']
+
+#---records for the current step along with our position in them
+stage_state = {'step':None,'records':[],'index':0,'fresh':True,'depth':0}
+
+#---file hashes by path with the size and modification time used to validate them
+stage_digests = {}
+
+def plain(obj):
+
+	"""
+	Convert the unicode strings from JSON back to strings so restored values match the originals.
+	"""
+
+	if type(obj)==unicode:
+		try: return str(obj)
+		except UnicodeEncodeError: return obj
+	elif type(obj)==list: return [plain(i) for i in obj]
+	elif type(obj)==dict: return dict([(plain(k),plain(v)) for k,v in obj.items()])
+	return obj
+
+def value_digest(key):
+
+	"""
+	Hash the value of a wordspace key or return None if it is absent.
+	"""
+
+	if not dict.__contains__(wordspace,key): return None
+	return hashlib.sha1(json.dumps(dict.get(wordspace,key),sort_keys=True,default=str)).hexdigest()
+
+def file_fingerprint(fn):
+
+	"""
+	Return the size, modification time and (for small files) the SHA1 hash of a file.
+	"""
+
+	stat = os.stat(fn)
+	stamp = [stat.st_size,stat.st_mtime]
+	if stat.st_size>stage_hash_limit: return stamp+[None]
+	if fn in stage_digests and stage_digests[fn][0]==stamp: return stamp+[stage_digests[fn][1]]
+	digest = hashlib.sha1()
+	with open(fn,'rb') as fp:
+		for block in iter(lambda:fp.read(1<<20),''): digest.update(block)
+	stage_digests[fn] = (stamp,digest.hexdigest())
+	return stamp+[digest.hexdigest()]
+
+def file_matches(fn,fingerprint):
+
+	"""
+	Check a file against a fingerprint. Files with a new modification time match if their contents agree.
+	"""
+
+	if not os.path.isfile(fn): return False
+	stat = os.stat(fn)
+	if stat.st_size!=fingerprint[0]: return False
+	if stat.st_mtime==fingerprint[1]: return True
+	return fingerprint[2]!=None and file_fingerprint(fn)[2]==fingerprint[2]
+
+def step_files():
+
+	"""
+	Fingerprint the files in the step directory except for logs that belong to the whole procedure.
+	"""
+
+	ignore = [os.path.abspath(i) for i in [wordspace.get('bash_log',''),
+		os.path.join(wordspace['step'],stage_record_name),os.path.join(wordspace['step'],'wordspace.json')]]
+	files = {}
+	for fn in os.listdir(wordspace['step']):
+		path = os.path.join(wordspace['step'],fn)
+		if not os.path.isfile(path) or re.match('^#.+#$',fn) or os.path.abspath(path) in ignore: continue
+		files[fn] = file_fingerprint(path)
+	return files
+
+def stage_records():
+
+	"""
+	Load the stage records for the current step once per run.
+	"""
+
+	if stage_state['step']!=wordspace['step']:
+		fn = os.path.join(wordspace['step'],stage_record_name)
+		records = []
+		if os.path.isfile(fn):
+			try:
+				with open(fn) as fp: records = plain(json.load(fp))
+			except ValueError: report('cannot read %s so every stage will run'%fn,tag='warning')
+		stage_state.update(step=wordspace['step'],records=records,index=0,fresh=True)
+	return stage_state['records']
+
+def write_stage_records():
+
+	"""
+	Write the stage records through a temporary file so a crash never leaves them half-written.
+	"""
+
+	fn = os.path.join(wordspace['step'],stage_record_name)
+	with open(fn+'.tmp','w') as fp: json.dump(stage_state['records'],fp,default=str)
+	os.rename(fn+'.tmp',fn)
+
+def stage_fresh(index,name,call):
+
+	"""
+	Decide if a recorded stage can be skipped.
+	"""
+
+	records = stage_state['records']
+	if index>=len(records): return False
+	record = records[index]
+	if record['name']!=name or record['call']!=call: return False
+	#---keys and files which a later stage changed are checked by that stage
+	later_keys = set([k for r in records[index:] for k in r['writes'].keys()+r['deletes']])
+	later_files = set([f for r in records[index+1:] for f in r['outputs'].keys()+r['removed']])
+	for key,digest in record['reads'].items():
+		if key not in later_keys and value_digest(key)!=digest: return False
+	for fn,fingerprint in record['inputs'].items():
+		if fn in later_files or fn in record['outputs'] or fn in record['removed']: continue
+		if not file_matches(os.path.join(wordspace['step'],fn),fingerprint): return False
+	for fn,fingerprint in record['outputs'].items():
+		if fn in later_files: continue
+		if not file_matches(os.path.join(wordspace['step'],fn),fingerprint): return False
+	for fn in record['removed']:
+		if fn not in later_files and os.path.isfile(os.path.join(wordspace['step'],fn)): return False
+	return True
+
+def stage(func):
+
+	"""
+	Make a procedure function incremental (see the module docstring).
+	Stages called from inside another stage are part of the outer stage.
+	"""
+
+	name = func.func_name
+	@wraps(func)
+	def func_stage(*args,**kwargs):
+		if stage_state['depth']>0 or 'step' not in wordspace: return func(*args,**kwargs)
+		records = stage_records()
+		index = stage_state['index']
+		call = hashlib.sha1(repr(args)+repr(sorted(kwargs.items()))).hexdigest()
+		stage_state['index'] += 1
+		if (stage_state['fresh'] and wordspace.get('incremental',True)
+			and stage_fresh(index,name,call)):
+			record = records[index]
+			for key,value in record['writes'].items(): wordspace[key] = value
+			for key in record['deletes']:
+				if key in wordspace: wordspace.pop(key)
+			report('skipping %s because it is up to date'%name,tag='status')
+			return record['result']
+		#---this stage and every stage after it runs again
+		if stage_state['fresh']:
+			stage_state['fresh'] = False
+			del records[index:]
+		before_keys = dict([(k,json.dumps(v,sort_keys=True,default=str)) for k,v in wordspace.items()])
+		before_files = step_files()
+		stage_state['depth'] += 1
+		WordSpace.reads = set()
+		try: result = func(*args,**kwargs)
+		finally:
+			stage_state['depth'] -= 1
+			reads,WordSpace.reads = WordSpace.reads,None
+		after_files = step_files()
+		after_keys = [k for k in wordspace.keys() if k not in stage_ignore_keys]
+		record = {'name':name,'call':call,
+			'reads':dict([(k,hashlib.sha1(before_keys[k]).hexdigest() if k in before_keys else None)
+				for k in reads if k not in stage_ignore_keys]),
+			'writes':dict([(k,wordspace[k]) for k in after_keys
+				if json.dumps(wordspace[k],sort_keys=True,default=str)!=before_keys.get(k,None)]),
+			'deletes':[k for k in before_keys if k not in wordspace and k not in stage_ignore_keys],
+			'inputs':before_files,
+			'outputs':dict([(fn,fp) for fn,fp in after_files.items() if before_files.get(fn,None)!=fp]),
+			'removed':[fn for fn in before_files if fn not in after_files],'result':result}
+		records.append(record)
+		write_stage_records()
+		return result
+	return func_stage
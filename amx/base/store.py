@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+"""
+Indexed store for the wordspace checkpoints.
+
+Every checkpoint is also written to a small SQLite database in the project root. Each checkpoint is keyed by
+its step, the last part number in the step and a timestamp, and holds the keys which changed since the
+previous checkpoint (or every key for the full snapshots, see checkpoint). Rebuilding the wordspace for a step
+only reads the rows since the last full snapshot in that step, and the latest value of a key across all steps
+is a single indexed query, so neither depends on the size of the logs. The logs remain the record of the
+simulation and are read instead whenever the store is missing or does not know a step. Each checkpoint also
+holds a hash of the line it wrote to the log so that a store which missed a checkpoint (after a database
+error or while wordspace_store was off) is caught by comparing it with the last checkpoint in the log.
+"""
+
+import os,re,json,time,sqlite3,hashlib
+
+#---name of the database in the project root
+store_name = 'wordspace.sqlite'
+
+#---seconds to wait for another process which is writing to the store
+store_timeout = 30.0
+
+store_schema = """
+CREATE TABLE IF NOT EXISTS checkpoints (id INTEGER PRIMARY KEY, step TEXT, part INTEGER, time REAL,
+	full INTEGER, digest TEXT);
+CREATE TABLE IF NOT EXISTS entries (checkpoint INTEGER, step TEXT, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS checkpoints_step ON checkpoints (step, full, id);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (key, step, checkpoint);
+CREATE INDEX IF NOT EXISTS entries_step ON entries (step, checkpoint);
+"""
+
+def step_name(step):
+
+	"""
+	Name of a step in the store, which is the step folder without the trailing slash.
+	"""
+
+	return os.path.basename(os.path.normpath(step))
+
+def checkpoint_digest(text):
+
+	"""
+	Hash of the text of a checkpoint line in the log (without the tag).
+	"""
+
+	return hashlib.sha1(text).hexdigest()
+
+def store_connect(create=False):
+
+	"""
+	Open the store or return None if it does not exist and we are not creating it.
+	"""
+
+	if not create and not os.path.isfile(store_name): return None
+	conn = sqlite3.connect(store_name,timeout=store_timeout)
+	if create: conn.executescript(store_schema)
+	return conn
+
+def store_checkpoint(step,part,values,unset,full=False,digest=None):
+
+	"""
+	Record a checkpoint for a step in one transaction.
+	The values are JSON strings by key and the unset keys are stored with a null value. The digest is the
+	checkpoint_digest of the line written to the log.
+	"""
+
+	conn = store_connect(create=True)
+	try:
+		with conn:
+			cursor = conn.execute('INSERT INTO checkpoints (step,part,time,full,digest) VALUES (?,?,?,?,?)',
+				(step_name(step),part,time.time(),1 if full else 0,digest))
+			index = cursor.lastrowid
+			conn.executemany('INSERT INTO entries (checkpoint,step,key,value) VALUES (?,?,?,?)',
+				[(index,step_name(step),key,val) for key,val in values.items()]+
+				[(index,step_name(step),key,None) for key in unset])
+	finally: conn.close()
+
+def stored_digest(step):
+
+	"""
+	Digest of the last checkpoint that the store holds for a step or None.
+	"""
+
+	conn = store_connect()
+	if not conn: return None
+	try:
+		last = conn.execute('SELECT digest FROM checkpoints WHERE step=? ORDER BY id DESC LIMIT 1',
+			(step_name(step),)).fetchone()
+		return last[0] if last else None
+	except sqlite3.Error: return None
+	finally: conn.close()
+
+def stored_wordspace(step,digest):
+
+	"""
+	Rebuild the wordspace for a step from its last full snapshot and the checkpoints that follow it.
+	Returns None if the store has no snapshot for the step or if its last checkpoint does not have the digest
+	of the last checkpoint in the log.
+	"""
+
+	if digest == None or stored_digest(step)!=digest: return None
+	conn = store_connect()
+	if not conn: return None
+	try:
+		last_full = conn.execute('SELECT MAX(id) FROM checkpoints WHERE step=? AND full=1',
+			(step_name(step),)).fetchone()[0]
+		if last_full == None: return None
+		state = {}
+		for key,val in conn.execute('SELECT key,value FROM entries WHERE step=? AND checkpoint>=? '+
+			'ORDER BY checkpoint',(step_name(step),last_full)):
+			if val == None: state.pop(key,None)
+			else: state[key] = json.loads(val)
+		return state
+	except sqlite3.Error: return None
+	finally: conn.close()
+
+def stored_value(key,steps=None):
+
+	"""
+	Return the latest step which holds a key in its last checkpoint along with the value.
+	Steps are searched from the last one backwards and may be limited to a list of step folders so that steps
+	which were deleted are ignored. Returns (None,None) if no step has the key or the store is missing.
+	"""
+
+	conn = store_connect()
+	if not conn: return None,None
+	try:
+		last_full = dict(conn.execute('SELECT step,MAX(id) FROM checkpoints WHERE full=1 GROUP BY step'))
+		if steps != None:
+			last_full = dict([(s,i) for s,i in last_full.items() if s in [step_name(j) for j in steps]])
+		decided = set()
+		for step,index,val in conn.execute('SELECT step,checkpoint,value FROM entries WHERE key=? '+
+			'ORDER BY step DESC,checkpoint DESC',(key,)):
+			#---only the newest row since the last snapshot of each step counts
+			if step not in last_full or step in decided or index<last_full[step]: continue
+			if val != None: return step,json.loads(val)
+			decided.add(step)
+		return None,None
+	except sqlite3.Error: return None,None
+	finally: conn.close()
+
+def last_part(filenames):
+
+	"""
+	Highest part number among the checkpoint files in a step.
+	"""
+
+	parts = [int(i) for fn in filenames for i in re.findall('^md\.part([0-9]{4})\.cpt$',fn)]
+	return max(parts) if parts else None
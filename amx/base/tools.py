@@ -1,6 +1,26 @@
 #!/usr/bin/python
 
-import inspect,re,glob,os
+import inspect,re,glob,os,ast
+from manifest import project_steps,step_parts
+
+def reverse_lines(fn,block=65536):
+
+	"""
+	Iterate over the lines of a file from the end without reading all of it.
+	"""
+
+	with open(fn,'rb') as fp:
+		fp.seek(0,os.SEEK_END)
+		position,tail = fp.tell(),''
+		while position>0:
+			step = min(block,position)
+			position -= step
+			fp.seek(position)
+			lines = (fp.read(step)+tail).split('\n')
+			#---the first piece may be part of a longer line so we keep it for the next block
+			tail = lines.pop(0)
+			for line in lines[::-1]: yield line
+		yield tail
 
 def asciitree(obj,depth=0,wide=2,last=[],recursed=False):
 
@@ -57,51 +77,129 @@ def asciitree(obj,depth=0,wide=2,last=[],recursed=False):
 	else: print 'unhandled tree object'
 	if not recursed: print '\n'
 	
+#---names which settings may use in place of literals
+literal_names = {'True':True,'False':False,'None':None}
+
+#---operators allowed in settings with a limit on exponents so a typo cannot hang the parser
+literal_operators = {
+	ast.Add:lambda a,b:a+b,ast.Sub:lambda a,b:a-b,ast.Mult:lambda a,b:a*b,ast.Div:lambda a,b:a/b,
+	ast.Mod:lambda a,b:a%b,ast.Pow:lambda a,b:a**b if abs(b)<=64 else None,
+	ast.USub:lambda a:-a,ast.UAdd:lambda a:+a}
+
+def literal_value(node):
+
+	"""
+	Evaluate an expression tree made of literals, arithmetic on numbers and subscripts.
+	Anything else (names, calls, attributes) raises a ValueError.
+	"""
+
+	if isinstance(node,ast.Expression): return literal_value(node.body)
+	elif isinstance(node,ast.Str): return node.s
+	elif isinstance(node,ast.Num): return node.n
+	elif isinstance(node,ast.Name) and node.id in literal_names: return literal_names[node.id]
+	elif isinstance(node,ast.Tuple): return tuple([literal_value(i) for i in node.elts])
+	elif isinstance(node,ast.List): return [literal_value(i) for i in node.elts]
+	elif isinstance(node,ast.Set): return set([literal_value(i) for i in node.elts])
+	elif isinstance(node,ast.Dict): 
+		return dict([(literal_value(k),literal_value(v)) for k,v in zip(node.keys,node.values)])
+	elif isinstance(node,ast.UnaryOp) and type(node.op) in literal_operators:
+		operand = literal_value(node.operand)
+		if type(operand) in [int,long,float,complex]: return literal_operators[type(node.op)](operand)
+	elif isinstance(node,ast.BinOp) and type(node.op) in literal_operators:
+		left,right = literal_value(node.left),literal_value(node.right)
+		numbers = [int,long,float,complex]
+		#---only numbers and adding two sequences of the same kind
+		if type(left) in numbers and type(right) in numbers: 
+			result = literal_operators[type(node.op)](left,right)
+			if result != None: return result
+		elif type(node.op)==ast.Add and type(left)==type(right) and type(left) in [str,unicode,list,tuple]:
+			return left+right
+	elif isinstance(node,ast.Subscript):
+		value = literal_value(node.value)
+		if isinstance(node.slice,ast.Index): return value[literal_value(node.slice.value)]
+		elif isinstance(node.slice,ast.Slice):
+			return value[slice(*[literal_value(i) if i else None 
+				for i in [node.slice.lower,node.slice.upper,node.slice.step]])]
+	raise ValueError('settings values must be literals: %s'%ast.dump(node))
+
+def literal_eval(text):
+
+	"""
+	Safe replacement for eval on settings values (see literal_value).
+	Leading spaces and tabs are ignored like they are by eval.
+	"""
+
+	return literal_value(ast.parse(text.lstrip(' \t'),mode='eval'))
+
 def yamlparse(text,style=None):
 
 	"""
 	A function which reads the settings files in yaml format.
+	Each line holds a key and a value separated by the first colon and spaces in keys become underscores.
+	A key followed by ":|" starts a block value which continues over the following lines that share the
+	indentation of its first line. The indentation and newlines are removed from blocks, or in the tabbed
+	style the newlines are kept and one leading tab is removed from each line. Values are read with 
+	literal_eval if possible and strings that look like booleans or numbers are converted.
+	The text is read line by line in a single pass.
 	DEVELOPMENT NOTE: this will ignore lines if your forget a colon. Needs better error checking.
 	"""
 	
-	unpacked = {}
-	#---evaluate code blocks first
-	regex_block_standard = r"^\s*([^\n]*?)\s*(?:\s*:\s*\|)\s*([^\n]*?)\n(\s+)(.*?)\n(?!\3)"
-	regex_block_tabbed = r"^\s*([^\n]*?)\s*(?:\s*:\s*\|)\s*\n(.*?)\n(?!\t)"
-	if style == 'tabbed': regex_block = regex_block_tabbed
-	else: regex_block = regex_block_standard
-	regex_line = r"^\s*(.*?)\s*(?:\s*:\s*)\s*(.+)$"
-	while True:
-		blockoff = re.search(regex_block,text,re.M+re.DOTALL)
-		if not blockoff: break
-		if style == 'tabbed': key,block = blockoff.groups()[:2]
-		else: 
-			#---collect the key, indentation for replacement, and value
-			key,indent,block = blockoff.group(1),blockoff.group(3),''.join(blockoff.groups()[1:])
-		#---alternate style does multiline blocks with a single tab character
-		if style == 'tabbed': compact = re.sub("(\n\t)",r'\n',block.lstrip('\t'),re.M)
-		#---remove indentations and newlines (default)
-		else: compact = re.sub('\n','',re.sub(indent,'',block))
-		unpacked[re.sub(' ','_',key)] = compact
-		#---remove the block
-		text = re.sub(re.escape(text[slice(*blockoff.span())]),'',text)
-	while True:
-		line = re.search(regex_line,text,re.M)
-		if not line: break
-		key,val = line.groups()
-		assert key not in unpacked
-		unpacked[re.sub(' ','_',key)] = val
-		text = re.sub(re.escape(text[slice(*line.span())]),'',text)
+	unpacked,raw = {},{}
+	lines = text.split('\n')
+	regex_header = '^\s*(.*?)\s*:\s*\|(.*)$'
+	regex_line = '^\s*(.*?)\s*:\s*(.*)$'
+	indentation = lambda x:x[:len(x)-len(x.lstrip())]
+	#---a block needs its last line to end in a newline
+	def block_end(start,indent):
+		end = start
+		while end<len(lines) and lines[end].startswith(indent): end += 1
+		return end if end<len(lines) else None
+	index = 0
+	while index<len(lines):
+		line,value = lines[index],None
+		header = re.match(regex_header,line)
+		if header and style == 'tabbed' and not header.group(2).strip():
+			#---the tabbed block starts at the next line with text and continues over lines with tabs
+			start = index+1
+			while start<len(lines) and not lines[start].strip(): start += 1
+			end = block_end(start+1,'\t') if start<len(lines) else None
+			if end != None:
+				value = '\n'.join([lines[start].lstrip('\t')]+[i[1:] for i in lines[start+1:end]])
+				key,index = header.group(1),end
+		elif header and style != 'tabbed':
+			#---text after the bar starts the block, otherwise the first line does
+			tail = header.group(2).lstrip()
+			if tail: start,head = index+1,tail
+			elif index+2<len(lines) and indentation(lines[index+2]): start,head = index+2,lines[index+1].lstrip()
+			else: start,head = index+1,''
+			indent = indentation(lines[start]) if start<len(lines) else ''
+			end = block_end(start,indent) if indent else None
+			if end != None:
+				value = (head+'\n'.join(lines[start:end])).replace(indent,'').replace('\n','')
+				key,index = header.group(1),end
+		if value == None:
+			match = re.match(regex_line,line)
+			index += 1
+			if not match: continue
+			key,value = match.groups()
+			#---a key with nothing after the colon takes the next line with text as its value
+			if not value.strip():
+				while index<len(lines) and not lines[index].strip(): index += 1
+				if index==len(lines): continue
+				value,index = lines[index].lstrip(),index+1
+		name = re.sub(' ','_',key)
+		if name in raw and raw[name]!=value:
+			raise Exception('[ERROR] the setting "%s" appears more than once with different values'%key)
+		raw[name] = value
 	#---evaluate rules to process the results
-	for key,val in unpacked.items():
+	for key,val in raw.items():
 		#---store according to evaluation rules
-		try: val = eval(val)
-		except: pass
+		try: val = literal_eval(val)
+		except Exception: pass
 		if type(val)==list: unpacked[key] = val
 		elif type(val)==str:
 			if re.match('^(T|t)rue$',val): unpacked[key] = True
 			elif re.match('^(F|f)alse$',val): unpacked[key] = False
-			#---! may be redundant with the eval command above
 			elif re.match('^[0-9]+$',val): unpacked[key] = int(val)
 			elif re.match('^[0-9]*\.[0-9]*$',val): unpacked[key] = float(val)
 			else: unpacked[key] = val
@@ -114,22 +212,14 @@ def detect_last(steplist=False):
 	Find the last step number and part number (if available).
 	"""
 
-	step_regex = '^s([0-9]+)-[\w-]+$'
-	part_regex = '^[^\/]+\/md\.part([0-9]{4})\.cpt' 
-	possible_steps = [i for i in glob.glob('s*-*') if os.path.isdir(i)]
-	try:
-		last_step_num = max(map(
-			lambda z:int(z),map(
-			lambda y:re.findall(step_regex,y).pop(),filter(
-			lambda x:re.match(step_regex,x),possible_steps))))
-		last_step = os.path.join(filter(lambda x:re.match('^s%02d.'%last_step_num,x),possible_steps).pop(),'')
-	except: last_step = None
-	part_num = None
-	try:
-		possible_parts = glob.glob(last_step+'/*.cpt')
-		part_num = max(map(lambda y:int(re.findall(part_regex,y)[0]),filter(
-			lambda x:re.match(part_regex,x),possible_parts)))
-	except: pass
+	#---steps and parts come from the project manifest which only lists folders that changed
+	possible_steps = project_steps(prefix='s')
+	last_step,part_num = None,None
+	if possible_steps:
+		last_step_num = max([int(re.findall('^s([0-9]+)',i)[0]) for i in possible_steps])
+		last_step = os.path.join(filter(lambda x:re.match('^s%02d-'%last_step_num,x),possible_steps).pop(),'')
+		parts = step_parts(last_step,suffix='cpt')
+		if parts: part_num = parts[-1]
 	#---sometimes we want a list of all step folders so this returns one, without parts
 	if steplist: return sorted(possible_steps)
 	return last_step,part_num
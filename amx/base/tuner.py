@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""
+Find the fastest way to launch mdrun on this machine.
+
+The tuner runs short mdrun trials on a TPR over a grid of thread-MPI ranks, OpenMP threads per rank, separate
+PME ranks and neighbor list intervals that fit in the thread budget (nprocs in the machine configuration or
+every core). Each trial resets its counters halfway (-resethway) so that startup and load balancing are not
+counted, and the performance is read from its log. The first trial is the plain "-nt <nprocs>" launch that
+AUTOMACS uses by default. The fastest flags are stored in mdrun_tuning_file under the host, the machine and
+the budget. prepare_machine_configuration reads them from there into mdrun_flags, which prepare_gmxpaths
+uses instead of "-nt". The trials run in tune-<name> in the project root and their timings are kept in
+timings.json there.
+
+Neighbor list intervals are only swept on request (nstlist) since mdrun refuses -nstlist for energy
+minimization and for the group cutoff scheme. The stored flags never include -nstlist because they apply to
+every mdrun. The best interval is reported and recorded with the tuning so that it can be set with the nstlist
+parameter in the MDP files for dynamics with the Verlet scheme.
+"""
+
+import os,re,json,time,subprocess,multiprocessing
+from amx.base.gromacs import gmxpaths,machine_configuration,this_machine,write_mdrun_tuning
+
+#---flags which the tuner sets and therefore removes from the configured mdrun command
+tuner_flags = ['nt','ntmpi','ntomp','npme','nstlist']
+
+#---flags which are specific to a system and integrator and therefore never stored for every mdrun
+tuner_system_flags = ['nstlist']
+
+#---performance line at the end of an mdrun log
+regex_performance = '^Performance:\s+([0-9]+\.?[0-9]*)'
+
+def tuner_choices(text):
+
+	"""
+	Split a list of choices from the command line where "auto" leaves the choice to mdrun.
+	"""
+
+	return [None if i=='auto' else int(i) for i in re.split('[,:\s]+',str(text).strip()) if i]
+
+def tuning_trials(nprocs,pme='auto',nstlist='auto'):
+
+	"""
+	List the trials which use every thread in the budget, starting from the default launch.
+	Separate PME ranks are only tried when they leave at least half of the ranks for the particles.
+	"""
+
+	trials = [{'nt':nprocs}]
+	for ntmpi in [i for i in range(1,nprocs+1) if nprocs%i==0]:
+		for npme in tuner_choices(pme):
+			if npme!=None and (ntmpi==1 or 2*npme>ntmpi): continue
+			for nst in tuner_choices(nstlist):
+				trial = {'ntmpi':ntmpi,'ntomp':nprocs/ntmpi,'npme':npme,'nstlist':nst}
+				trials.append(dict([(k,v) for k,v in trial.items() if v!=None]))
+	return trials
+
+def trial_flags(trial,exclude=()):
+
+	"""
+	Flags for mdrun for one trial in a fixed order.
+	"""
+
+	return ' '.join(['-%s %d'%(key,trial[key]) for key in tuner_flags if key in trial and key not in exclude])
+
+def mdrun_base():
+
+	"""
+	The configured mdrun command without the flags which the tuner sets.
+	"""
+
+	if 'mdrun_command' in machine_configuration:
+		raise Exception('[ERROR] cannot tune the mdrun_command from the machine configuration')
+	base = gmxpaths['mdrun']
+	if 'mdrun_flags' in machine_configuration: base = base.replace(' '+machine_configuration['mdrun_flags'],'')
+	return re.sub('\s+-(%s)\s+-?[0-9]+'%'|'.join(tuner_flags),'',base)
+
+def run_trial(base,tpr,folder,name,flags,nsteps):
+
+	"""
+	Run one trial and return the performance in ns/day or None if mdrun failed.
+	"""
+
+	for fn in [i for i in os.listdir(folder) if re.match('^%s\.'%name,i)]: os.remove(os.path.join(folder,fn))
+	cmd = '%s -s %s -deffnm %s -nsteps %d -resethway -noconfout %s'%(base,tpr,name,nsteps,flags)
+	with open(os.path.join(folder,'log-'+name),'w') as log:
+		subprocess.call(cmd,cwd=folder,shell=True,executable='/bin/bash',stdout=log,stderr=log)
+	if not os.path.isfile(os.path.join(folder,name+'.log')): return None
+	with open(os.path.join(folder,name+'.log')) as fp: performance = re.search(regex_performance,fp.read(),re.M)
+	return float(performance.group(1)) if performance else None
+
+def run_tuner(tpr,nprocs=None,nsteps=4000,pme='auto,0,2,4',nstlist='auto',dry=False):
+
+	"""
+	Time mdrun over the trials for a TPR and store the fastest flags for this machine and budget.
+	"""
+
+	if not os.path.isfile(tpr): raise Exception('[ERROR] cannot find %s'%tpr)
+	tpr = os.path.abspath(tpr)
+	if not nprocs: nprocs = machine_configuration.get('nprocs',None)
+	nprocs = int(nprocs) if nprocs else multiprocessing.cpu_count()
+	trials = tuning_trials(nprocs,pme=pme,nstlist=nstlist)
+	folder = 'tune-%s'%os.path.splitext(os.path.basename(tpr))[0]
+	base = mdrun_base()
+	print '[STATUS] tuning "%s" on %d threads with %d trials in %s'%(base,nprocs,len(trials),folder)
+	if dry:
+		for ii,trial in enumerate(trials): print '[STATUS] trial%02d %s'%(ii,trial_flags(trial))
+		return
+	if not os.path.isdir(folder): os.mkdir(folder)
+	timings = []
+	for ii,trial in enumerate(trials):
+		nsday = run_trial(base,tpr,folder,'trial%02d'%ii,trial_flags(trial),int(nsteps))
+		timings.append({'trial':'trial%02d'%ii,'flags':trial_flags(trial),'nsday':nsday,
+			'stored':trial_flags(trial,exclude=tuner_system_flags),'nstlist':trial.get('nstlist',None)})
+		print '[STATUS] trial%02d %-45s %s'%(ii,trial_flags(trial),
+			'%.3f ns/day'%nsday if nsday!=None else 'failed (see %s/log-trial%02d)'%(folder,ii))
+		with open(os.path.join(folder,'timings.json'),'w') as fp: json.dump(timings,fp,indent=1)
+	finished = [i for i in timings if i['nsday']!=None]
+	if not finished: raise Exception('[ERROR] every trial failed so check the logs in %s'%folder)
+	best = max(finished,key=lambda x:x['nsday'])
+	if timings[0]['nsday']:
+		print '[STATUS] fastest is %s at %.3f ns/day (%.2fx the default)'%(
+			best['flags'],best['nsday'],best['nsday']/timings[0]['nsday'])
+	else: print '[STATUS] fastest is %s at %.3f ns/day'%(best['flags'],best['nsday'])
+	#---the tuning is keyed by the budget we used which may differ from the configured nprocs
+	config = dict(machine_configuration)
+	config['nprocs'] = nprocs
+	write_mdrun_tuning(config,this_machine,{'flags':best['stored'],'nsday':best['nsday'],
+		'nstlist':best['nstlist'],'tpr':tpr,'nsteps':int(nsteps),'time':time.time()})
+	if best['nstlist']!=None:
+		print '[NOTE] set "nstlist: %d" in the MDP parameters for dynamics on this system'%best['nstlist']
+	print '[STATUS] mdrun uses "%s" on this machine with nprocs %d from now on'%(best['stored'],nprocs)
+	return best
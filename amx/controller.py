@@ -4,6 +4,7 @@ import sys,os,re,shutil,glob,inspect,subprocess,datetime,time
 from base.config import bootstrap_configuration
 from base.metatools import script_settings_replace
 from base.tools import detect_last,serial_number
+from base.manifest import project_steps
 
 #---CONFIGURE
 #-------------------------------------------------------------------------------------------------------------
@@ -73,7 +74,7 @@ def clean(sure=False,docs=False):
 	remove_files = [i for i in filenames if i != 'config.py' and 
 		(re.match('^script-[sv][0-9]+',i) or re.match('^([\w-]+)\.py$',i) or re.match('^serial',i)
 		or re.match('^(cluster|gmxjob)',i) or i in [
-			'wordspace.json','script-batch-submit.sh','ERROR.log',
+			'wordspace.json','wordspace.sqlite','manifest.json','script-batch-submit.sh','ERROR.log',
 			])]
 	if docs: 
 		print '[STATUS] cleaning docs only'
@@ -107,7 +108,7 @@ def upload(sure=False,part=None,bulk=False):
 	last_step,part_num = detect_last()
 	if part: 
 		part_num = int(part)
-		last_step, = [i for i in glob.glob('s%02d-*'%part_num)]
+		last_step, = [i for i in project_steps(prefix='s') if re.match('^s%02d-'%part_num,i)]
 	if not last_step and not bulk: raise Exception('\n[ERROR] no steps to upload (try "bulk" instead)')
 	elif last_step and not bulk:
 		if not part_num: raise Exception('\n[ERROR] cannot find a part number (did you mean "bulk"?)')
@@ -270,6 +271,59 @@ def metarun(script=None,more=False):
 		else: raise Exception('[ERROR] failed to match %s with known scripts'%script)
 		execfile(which_script)
 
+def ensemble(name=None,cores=None,rerun=False,dry=False):
+
+	"""
+	Run a procedure over a sweep of settings described by inputs/ensemble-<name>.py.
+	Each member gets its own project folder in ensemble-<name> and the members run in parallel on the cores 
+	of this machine (or the number given by cores). Use dry to prepare the folders without running them and 
+	rerun to run members which already finished. See amx/base/ensemble.py for the format of the spec.
+	"""
+
+	from base.ensemble import run_ensemble,ensemble_candidates
+	if not name:
+		print "[USAGE] make ensemble <name> (cores=<n>) (dry) (rerun)"
+		print "[USAGE] available ensembles: \n > "+'\n > '.join(sorted(ensemble_candidates().keys()))
+	else: run_ensemble(name,cores=cores,rerun=rerun,dry=dry)
+
+def ensemble_status(name):
+
+	"""
+	Print the status table for an ensemble.
+	"""
+
+	from base.ensemble import ensemble_spec,read_status,status_table,ensemble_summary
+	#---batches made without a spec file (e.g. protein_batch) are found by their folder
+	if not os.path.isdir('ensemble-%s'%name): name = ensemble_spec(name)['name']
+	status = read_status(name)
+	if not status: print '[STATUS] ensemble %s has not been prepared'%name
+	else: 
+		print status_table(status)
+		print ensemble_summary(name,status)
+
+def protein_batch(structures=None,nprocs=None,concurrent=None,rerun=False,dry=False):
+
+	"""
+	Run the atomistic protein procedure on many structures at once.
+	Structures is a folder of PDB files (make protein_batch inputs) or a quoted glob passed by name so that the
+	shell does not expand it (make protein_batch structures="inputs/*.pdb"). Each structure gets its own 
+	project folder in ensemble-protein-batch named after the structure. The total thread budget (nprocs, all
+	cores by default) is split between the concurrent members so that their mdrun calls do not compete. A 
+	summary of the successes and failures is printed at the end and kept in ensemble-protein-batch/summary.txt.
+	"""
+
+	from base.ensemble import run_ensemble,protein_batch_spec
+	usage = ('[USAGE] make protein_batch <folder> or structures="<glob>" '+
+		'(nprocs=<n>) (concurrent=<n>) (dry) (rerun)')
+	#---a glob which the shell expanded arrives as extra arguments in place of the numbers
+	if any([i!=None and not re.match('^[0-9]+$',str(i)) for i in [nprocs,concurrent]]):
+		raise Exception('[ERROR] nprocs and concurrent must be numbers. Quote globs as structures="<glob>". '+
+			'Received: %s %s'%(nprocs,concurrent))
+	if not structures: print usage
+	else: 
+		spec = protein_batch_spec(structures,nprocs=nprocs,concurrent=concurrent)
+		run_ensemble(spec,cores=spec['cores']*spec['concurrent'],rerun=rerun,dry=dry)
+
 def look(script='',dump=True,step=None):
 
 	"""
@@ -459,13 +513,13 @@ def makeface(*arglist):
 	arglist = list(arglist)
 	funcname = arglist.pop(0)
 	#---regex for kwargs. note that the makefile organizes the flags for us
-	regex_kwargs = '^(\w+)\="?([\w:\-\.\/\s]+)"?$'
+	#---glob characters are allowed so that patterns like structures="inputs/*.pdb" reach the functions
+	regex_kwargs = '^(\w+)\="?([\w:\-\.\/\s\*\?\[\]]+)"?$'
 	while arglist:
 		arg = arglist.pop()
 		#---note that it is crucial that the following group contains all incoming 
 		if re.match(regex_kwargs,arg):
 			parname,parval = re.findall(regex_kwargs,arg)[0]
-			parname,parval = re.findall('^(\w+)\="?([\w:\-\.\/\s]+)"?$',arg)[0]
 			kwargs[parname] = parval
 		else:
 			argspec = inspect.getargspec(globals()[funcname])
@@ -3,6 +3,7 @@
 import re,os,subprocess
 from amx import wordspace
 from amx.base.journal import status
+from amx.base.stages import stage
 from amx.base.functions import filecopy
 from amx.base.gmxwrap import gmx,gmx_run,checkpoint
 from amx.base.gromacs import gmxpaths
@@ -10,6 +11,9 @@ from amx.base.journal import *
 from amx.procedures.common import *
 import numpy as np
 from codes.mesh import *
+from codes.groio import read_gro_structure,write_gro_structure,write_gro_blocks,gro_atoms,dotplace
+from codes.placement import placed_lipid_blocks
+from codes.templates import load_template
 import random
 
 """
@@ -40,9 +44,6 @@ mdp_specs = {
 #---FUNCTIONS
 #-------------------------------------------------------------------------------------------------------------
 
-#---ensure decimal alignment for GRO format
-dotplace = lambda n: re.compile(r'(\d)0+$').sub(r'\1',"%8.3f"%float(n)).ljust(8)
-
 def rotation_matrix(axis,theta):
 
 	"""
@@ -65,14 +66,12 @@ def read_molecule(gro):
 
 	"""
 	Read a molecule in GRO form and return its XYZ coordinates and atomnames.
-	!REPLACE WITH common.read_gro
+	Centered templates are loaded from the binary template cache (see codes.templates).
 	"""
 
-	with open(wordspace['lipid_structures']+'/'+gro+'.gro','r') as fp: rawgro = fp.readlines()
-	pts = np.array([[float(j) for j in i.strip('\n')[20:].split()] for i in rawgro[2:-1]])
-	pts -= mean(pts,axis=0)
-	atomnames = np.array([i.strip('\n')[10:15].strip(' ') for i in rawgro[2:-1]])
-	return pts,atomnames
+	atoms = load_template(wordspace['lipid_structures']+'/'+gro+'.gro',center=True,
+		cache=wordspace.get('template_cache',None))
+	return atoms['xyz'],atoms['atomname']
 
 def random_lipids(total,composition,binsize):
 
@@ -159,6 +158,7 @@ def makeshape():
 	return pts,monolayer_meshes,array([v for v in vecs]+[lz])
 
 @narrate
+@stage
 def build_bilayer(name,random_rotation=True):
 
 	"""
@@ -202,57 +202,21 @@ def build_bilayer(name,random_rotation=True):
 			key=lambda *args:random.random()))]
 
 	mono_offset = wordspace['monolayer_offset']
-	#---we wish to preserve the ordering of the lipids so we write them in order of identity
-	placements = [[] for l in lipid_order]
-	#---loop over lipid types
-	for lipid_num,lipid in enumerate(lipid_order):
-		lpts = lipids[lipid]['lpts']
-		#---loop over monolayers
-		for mn in range(2):
-			zvec = np.array([0,0,1]) if mn==0 else np.array([0,0,-1])
-			#---loop over positions of this lipid type
-			indices = where(identities[mn]==lipid_num)[0]
-			for ii,index in enumerate(indices):
-				status('placing %s'%lipid,i=ii,looplen=len(indices))
-				#---begin move routine
-				point = ptsmid[mn][index]
-				offset = [1,-1][mn]*mono_offset*monolayer_mesh[mn]['vertnorms'][index]
-				if random_rotation:
-					random_angle = np.random.uniform()*2*np.pi
-					lpts_copy = dot(rotation_matrix(zvec,random_angle),lpts.T).T
-				else: lpts_copy = array(lpts)
-				xys = point+offset+[1,-1][mn]*dot(
-					rotation_matrix(cross(zvec,monolayer_mesh[mn]['vertnorms'][index]),
-					dot(zvec,monolayer_mesh[mn]['vertnorms'][index])),lpts_copy.T).T
-				#---end move routine
-				placements[lipid_num].append(xys)
 	natoms = sum([sum(concatenate(identities)==ii)*len(lipids[i]['lpts']) 
 		for ii,i in enumerate(lipid_order)])
-
-	#---write the placed lipids to a file
-	resnr = 1
-	with open(wordspace['step']+name+'.gro','w') as fp:
-		fp.write('%s\n'%wordspace['system_name']+'%d\n'%natoms)
-		#---loop over lipid types
-		for lipid_num,resname in enumerate(lipid_order):
-			atomnames = lipids[resname]['atomnames']
-			for xys in placements[lipid_num]:
-				fp.write('\n'.join([''.join([
-					str(resnr).rjust(5),
-					resname.ljust(5),
-					atomnames[i].rjust(5),
-					(str((resnr-1)*len(xys)+i+1).rjust(5))[:5],
-					''.join([dotplace(x) for x in xys[i]])])
-					for i in range(len(xys))])+'\n')
-				resnr += 1
-		fp.write(' '.join([dotplace(x) for x in vecs])+'\n')
-
-	#---save the slab dimensions for solvation
-	boxdims_old,boxdims = get_box_vectors(name)
-	wordspace['bilayer_dimensions_slab'] = boxdims
+	#---place and write the lipids in blocks in the order of lipid_order
+	#---set "build chunk" to a number of lipids to bound the memory used for very large membranes
+	blocks = placed_lipid_blocks(lipids,lipid_order,identities,ptsmid,monolayer_mesh,mono_offset,
+		random_rotation=random_rotation,chunk=wordspace.get('build_chunk',None),progress=status)
+	lower,upper = write_gro_blocks(wordspace['step']+name+'.gro',blocks,natoms,
+		box=vecs,title=wordspace['system_name'])
+
+	#---save the slab dimensions for solvation from the extent of the written coordinates
+	#---note that this matches get_box_vectors without reading the structure back into memory
+	wordspace['bilayer_dimensions_slab'] = [round(float(i),3) for i in upper-lower]
 	#---save composition for topology
 	for lipid_num,lipid in enumerate(lipid_order):
-		component(lipid,count=len(placements[lipid_num]))
+		component(lipid,count=sum(concatenate(identities)==lipid_num))
 
 @narrate
 def gro_combinator(*args,**kwargs):
@@ -279,20 +243,6 @@ def gro_combinator(*args,**kwargs):
 		if not box: fp.write(collection[0][-1])		
 		else: fp.write(' %.3f %.3f %.3f\n'%tuple(box))
 
-def read_gro(gro,cwd='./'):
-
-	"""
-	Read a GRO file into a standard form.
-	May be wet with read_molecule.
-	"""
-
-	groform = {'resid':(0,5),'resname':(5,10),'name':(10,15),'index':(15,20),'xyz':(20,None)}
-	with open(cwd+'/'+gro) as fp: rawgro = fp.readlines()
-	structure,points = [],zeros((len(rawgro)-3,3))
-	for line in rawgro[2:-1]: structure.append({key:line[slice(*val)] for key,val in groform.items()})
-	for ii,i in enumerate(structure): points[ii] = [float(j) for j in i.pop('xyz').split()]
-	return structure,points
-
 @narrate
 def adhere_protein_cgmd_bilayer(bilayer,combo,protein_complex=None):
 
@@ -331,63 +281,54 @@ def adhere_protein_cgmd_bilayer(bilayer,combo,protein_complex=None):
 	if False: meshpoints(focii)
 
 	#---read the protein and bilayer
-	combined,combined_points = read_gro(bilayer,cwd=wordspace['step'])
-	protein,protein_points = read_gro(adhere_structure,cwd=wordspace['step'])
+	incoming = read_gro_structure(cwd+bilayer)
+	combined = incoming['atoms']
+	protein = load_template(cwd+adhere_structure,cache=wordspace.get('template_cache',None))
 
 	#---take box vectors from the bilayer
-	with open(cwd+'/'+bilayer) as fp: rawgro = fp.readlines()
-	boxvecs = rawgro[-1]
+	boxvecs = incoming['box_line']
 
 	#---center the lattice in the middle of the XY plane of the box
-	center_shift = array([float(j)/2. for j in boxvecs.split()[:2]]+
+	center_shift = array(list(incoming['box'][:2]/2.)+
 		[z_shift])-concatenate((mean(grid_space,axis=0),[0]))
 
 	#---for each point in the lattice move the protein and combine the structures
+	placed = []
 	for translate in grid_space:
-		combined = protein + combined
-		combined_points = concatenate((protein_points+concatenate((translate,[0]))+center_shift,
-			combined_points))
+		moved = protein.copy()
+		moved['xyz'] += concatenate((translate,[0]))+center_shift
+		placed.insert(0,moved)
+	combined = concatenate(placed+[combined])
 
 	#---remove the nearest lipid to the PIP2
 	#---! this is a hack to find the only PIP2 after it's been added to the combined list
-	lipid_center = mean(combined_points[array([ii for ii,i in enumerate(combined) 
-		if i['resname']=='PIP2 '])],axis=0)
+	lipid_center = mean(combined['xyz'][combined['resname']=='PIP2'],axis=0)
 	#---! hack to specify which lipid to replace with PIP2
 	replacement_lipid = 'DOPC'
 	#---get absolute indices of the standard lipids
-	indices = array([ii for ii,i in enumerate(combined) if i['resname']==replacement_lipid.ljust(5)]) 
+	indices = where(combined['resname']==replacement_lipid)[0]
 	#---group indices by resid
-	resids = array([int(combined[i]['resid']) for i in indices])
+	resids,resid_groups = unique(combined['resid'][indices],return_inverse=True)
 	#---centroids of the standard lipids
-	cogs = array([mean(combined_points[indices][where(resids==r)],axis=0) for r in unique(resids)])
+	cogs = array([bincount(resid_groups,weights=combined['xyz'][indices][:,d]) 
+		for d in range(3)]).T/transpose([bincount(resid_groups)])
 	nearest = argmin(linalg.norm(cogs-lipid_center,axis=1))
-	nearest_resid = unique(resids)[nearest]
-	excise = array([ii for ii,i in enumerate(combined) if i['resid']=='%5s'%nearest_resid 
-		and i['resname']==replacement_lipid.ljust(5)])
-	combined = [i for ii,i in enumerate(combined) if ii not in excise]
-	combined_points = [i for ii,i in enumerate(combined_points) if ii not in excise]
+	nearest_resid = resids[nearest]
+	excise = all((combined['resid']==nearest_resid,combined['resname']==replacement_lipid),axis=0)
+	combined = combined[~excise]
 	#---remove lipids in the composition
 	component(replacement_lipid,count=component(replacement_lipid)-total_proteins)
 
 	#---renumber residues and atoms
 	if 0:
-		resnr = 1
-		last_resnr = int(combined[0]['resid'])
-		for index,line in enumerate(combined):
-			this_resnr = int(line['resid'])
-			if this_resnr != last_resnr: resnr += 1
-			line['resid'] = '%5s'%resnr
-			line['index'] = '%5s'%index
+		combined['resid'] = cumsum(concatenate(([1],diff(combined['resid'])!=0)))
+		combined['index'] = arange(len(combined))
 
 	#---write the combined file
-	with open(cwd+combo,'w') as fp:
-		fp.write('%s\n%d\n'%(name,len(combined)))
-		for index,line in enumerate(combined):
-			fp.write(''.join([('%5s'%line[key])[:5] for key in ['resid','resname','name','index']]+
-				[dotplace(x) for x in combined_points[index]])+'\n')
-		fp.write(boxvecs)
+	write_gro_structure(cwd+combo,combined,box=boxvecs,title=name)
 
 @narrate
+@stage
 def solvate_bilayer(structure='vacuum'):
 	
 	"""
@@ -396,7 +337,7 @@ def solvate_bilayer(structure='vacuum'):
 
 	#---check the size of the slab
 	incoming_structure = str(structure)
-	boxdims_old,boxdims = get_box_vectors(structure)
+	boxdims_old,boxdims = get_box_vectors(structure,extent=False)
 
 	#---! standardize these?
 	basedim = 3.64428
@@ -409,17 +350,13 @@ def solvate_bilayer(structure='vacuum'):
 		nbox=' '.join([str(int(i/basedim+1)) for i in newdims]),log='genconf')
 
 	#---trimming waters
-	with open(wordspace['step']+'solvate-empty-uncentered-untrimmed.gro','r') as fp:
-		lines = fp.readlines()
-	modlines = []
-	for line in lines[2:-1]:
-		coords = [float(i) for i in line[20:].split()][:3]
-		if all([coords[i]<newdims[i] for i in range(3)]): modlines.append(line)
+	incoming = read_gro_structure(wordspace['step']+'solvate-empty-uncentered-untrimmed.gro',raw=True)
+	inside = where(all(incoming['atoms']['xyz']<array(newdims),axis=1))[0]
 	with open(wordspace['step']+'solvate-empty-uncentered.gro','w') as fp:
-		fp.write(lines[0])
-		fp.write(str(len(modlines))+'\n')
-		for l in modlines: fp.write(l)
-		fp.write(lines[-1])
+		fp.write(incoming['title']+'\n')
+		fp.write(str(len(inside))+'\n')
+		for i in inside: fp.write(incoming['records'][i]+'\n')
+		fp.write(incoming['box_line']+'\n')
 
 	#---update waters
 	structure='solvate-empty-uncentered'
@@ -445,6 +382,7 @@ def solvate_bilayer(structure='vacuum'):
 	wordspace['water_without_ions'] = nwaters
 
 @narrate
+@stage
 def add_proteins():
 
 	"""
@@ -475,6 +413,7 @@ def add_proteins():
 		wordspace['mdp_specs']['input-md-in.mdp'].append({key:'protein'})
 
 @narrate
+@stage
 def counterion_renamer(structure):
 
 	"""
@@ -490,6 +429,7 @@ def counterion_renamer(structure):
 		for line in lines: fp.write(line)
 
 @narrate
+@stage
 def bilayer_middle(structure,gro):
 
 	"""
@@ -512,6 +452,7 @@ def bilayer_middle(structure,gro):
 		tpr='em-counterions-steep',log='trjconv-middle',inpipe="1\n0\n",flag='-center -pbc mol')
 
 @narrate
+@stage
 def bilayer_sorter(structure,ndx='system-groups'):
 
 	"""
@@ -547,6 +488,7 @@ def bilayer_sorter(structure,ndx='system-groups'):
 		inpipe=group_selector)
 
 @narrate
+@stage
 def remove_jump(structure,tpr,gro):
 
 	"""
@@ -558,6 +500,7 @@ def remove_jump(structure,tpr,gro):
 		log='trjconv-%s-nojump'%structure,flag='-pbc nojump')
 	os.remove(wordspace['step']+'log-'+'make-ndx-nojump')
 
+@stage
 def vacuum_pack(structure='vacuum',name='vacuum-pack',gro='vacuum-packed'):
 
 	"""
@@ -570,5 +513,5 @@ def vacuum_pack(structure='vacuum',name='vacuum-pack',gro='vacuum-packed'):
 	gmx('mdrun',base='md-%s'%name,log='mdrun-%s'%name,skip=True)
 	remove_jump(structure='md-%s'%name,tpr='md-'+name,gro='md-%s-nojump'%name)
 	filecopy(wordspace['step']+'md-%s-nojump.gro'%name,wordspace['step']+'%s.gro'%gro)
-	boxdims_old,boxdims = get_box_vectors(gro)
+	boxdims_old,boxdims = get_box_vectors(gro,extent=False)
 	wordspace['bilayer_dimensions_slab'][:2] = boxdims_old[:2]
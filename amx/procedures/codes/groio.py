@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+"""
+Columnar GRO reader and writer shared by all procedures.
+
+GRO files are fixed-width so we read the atom records into a character matrix and slice each column at
+once instead of building python lists line by line. Structures are held in a numpy structured array with
+one row per atom (see ``gro_dtype``) alongside the title and the box vectors.
+"""
+
+import os,re
+import numpy as np
+
+#---fixed-width columns for the residue and atom names and numbers
+gro_columns = [('resid',0,5,int),('resname',5,10,str),('atomname',10,15,str),('index',15,20,int)]
+
+#---residue names in the GROMACS "Water" group
+water_resnames = ['SOL','WAT','HOH','OHH','TIP','T3P','T4P','T5P','T3H']
+
+#---residue counts by path with the modification time and size used to validate them
+residue_counts = {}
+
+#---ensure decimal alignment for GRO format
+dotplace = lambda n: re.compile(r'(\d)0+$').sub(r'\1',"%8.3f"%float(n)).ljust(8)
+
+def gro_dtype(velocities=False):
+
+	"""
+	Structured dtype for the atoms in a GRO file.
+	"""
+
+	fields = [('resid','i4'),('resname','S5'),('atomname','S5'),('index','i4'),('xyz','f8',(3,))]
+	if velocities: fields.append(('v','f8',(3,)))
+	return np.dtype(fields)
+
+def gro_atoms(natoms,velocities=False):
+
+	"""
+	Return an empty atoms array which can be filled and sent to write_gro_structure.
+	"""
+
+	return np.zeros(natoms,dtype=gro_dtype(velocities=velocities))
+
+def read_gro_structure(fn,velocities=False,raw=False):
+
+	"""
+	Read a GRO file into a structured array of atoms.
+	Returns a dictionary with the title, the atoms, the box vectors and the original box line. Velocities
+	are only parsed when requested and present. Set raw to also return the unparsed atom records.
+	"""
+
+	with open(fn,'r') as fp: lines = fp.read().splitlines()
+	title = lines[0]
+	natoms = int(lines[1].split()[0])
+	records = lines[2:2+natoms]
+	box_line = lines[2+natoms]
+	if len(records)!=natoms: raise Exception('[ERROR] expecting %d atoms in %s'%(natoms,fn))
+	#---precision follows from the distance between the decimal points of the first two coordinates
+	first = records[0] if natoms>0 else ''
+	try:
+		decimal = first.index('.',20)
+		width = first.index('.',decimal+1)-decimal
+	except: width = 8
+	has_velocities = velocities and len(first.rstrip())>=20+6*width
+	atoms = gro_atoms(natoms,velocities=has_velocities)
+	if natoms>0:
+		#---pad the records to a common width and view them as a character matrix
+		block = np.array(records,dtype='S')
+		chars = block.view('S1').reshape(natoms,block.dtype.itemsize)
+		column = lambda start,stop: chars[:,start:stop].copy().view('S%d'%(stop-start)).ravel()
+		for key,start,stop,kind in gro_columns:
+			if kind==int: atoms[key] = column(start,stop).astype(int)
+			else: atoms[key] = np.char.strip(column(start,stop))
+		for dim in range(3):
+			atoms['xyz'][:,dim] = column(20+dim*width,20+(dim+1)*width).astype(float)
+		if has_velocities:
+			offset = 20+3*width
+			for dim in range(3):
+				atoms['v'][:,dim] = column(offset+dim*width,offset+(dim+1)*width).astype(float)
+	outgoing = {'title':title,'atoms':atoms,'box':np.array(box_line.split(),dtype=float),
+		'box_line':box_line}
+	if raw: outgoing['records'] = records
+	return outgoing
+
+def residue_starts(atoms):
+
+	"""
+	Mark the first atom of each residue. A new residue starts wherever the residue number or name changes,
+	which keeps residues distinct when the residue numbers wrap in large systems.
+	"""
+
+	starts = np.ones(len(atoms),dtype=bool)
+	starts[1:] = np.any((atoms['resid'][1:]!=atoms['resid'][:-1],
+		atoms['resname'][1:]!=atoms['resname'][:-1]),axis=0)
+	return starts
+
+def count_residues(fn,cache=True):
+
+	"""
+	Count the residues and atoms for each residue name in a GRO file.
+	Returns a dictionary from residue name to the number of residues and atoms. A new residue starts wherever
+	the residue number or name changes (see residue_starts). Counts are cached until the file changes.
+	"""
+
+	stat = os.stat(fn)
+	key,stamp = os.path.abspath(fn),(stat.st_mtime,stat.st_size)
+	if cache and key in residue_counts and residue_counts[key][0]==stamp: 
+		return dict([(k,dict(v)) for k,v in residue_counts[key][1].items()])
+	atoms = read_gro_structure(fn)['atoms']
+	starts = residue_starts(atoms)
+	names,natoms = np.unique(atoms['resname'],return_counts=True)
+	nresidues = dict(zip(*np.unique(atoms['resname'][starts],return_counts=True)))
+	counts = dict([(str(name),{'residues':int(nresidues[name]),'atoms':int(count)}) 
+		for name,count in zip(names,natoms)])
+	if cache: residue_counts[key] = (stamp,counts)
+	return dict([(k,dict(v)) for k,v in counts.items()])
+
+def read_gro_box(fn,tail=1024):
+
+	"""
+	Read the box line of a GRO file by seeking from the end so the atoms are never read.
+	"""
+
+	with open(fn,'rb') as fp:
+		fp.seek(0,os.SEEK_END)
+		size = fp.tell()
+		fp.seek(max(0,size-tail),os.SEEK_SET)
+		lines = [l for l in fp.read().splitlines() if l.strip()]
+	if not lines: raise Exception('[ERROR] cannot find the box line in %s'%fn)
+	return np.array(lines[-1].split(),dtype=float)
+
+def read_gro_extent(fn):
+
+	"""
+	Return the extent of the coordinates in a GRO file along each axis.
+	Only the three coordinate columns are converted so this is much cheaper than read_gro_structure.
+	"""
+
+	with open(fn,'r') as fp: 
+		fp.readline()
+		natoms = int(fp.readline().split()[0])
+		records = fp.read().splitlines()[:natoms]
+	if len(records)!=natoms: raise Exception('[ERROR] expecting %d atoms in %s'%(natoms,fn))
+	if natoms==0: return np.zeros(3)
+	#---precision follows from the distance between the decimal points as in read_gro_structure
+	try:
+		decimal = records[0].index('.',20)
+		width = records[0].index('.',decimal+1)-decimal
+	except: width = 8
+	block = np.array(records,dtype='S')
+	chars = block.view('S1').reshape(natoms,block.dtype.itemsize)
+	xyz = np.array([chars[:,20+dim*width:20+(dim+1)*width].copy().view('S%d'%width).ravel().astype(float)
+		for dim in range(3)])
+	return xyz.max(axis=1)-xyz.min(axis=1)
+
+def gro_box_lengths(box):
+
+	"""
+	Return the lengths of the three box vectors from the 3 or 9 values on a GRO box line.
+	The off-diagonal values follow the GRO order: v1(y) v1(z) v2(x) v2(z) v3(x) v3(y).
+	"""
+
+	box = np.asarray(box,dtype=float)
+	if len(box)==3: return box
+	vecs = np.array([[box[0],box[3],box[4]],[box[5],box[1],box[6]],[box[7],box[8],box[2]]])
+	return np.sqrt((vecs**2).sum(axis=1))
+
+def gro_numbers(values,width=5):
+
+	"""
+	Format integers as a right-justified character matrix. Values wrap at the column width like GROMACS.
+	"""
+
+	values = np.asarray(values,dtype=np.int64)%(10**width)
+	chars = np.empty((len(values),width),dtype=np.uint8)
+	for col in range(width):
+		place = 10**(width-col-1)
+		chars[:,col] = np.where((values>=place)|(place==1),48+(values//place)%10,32)
+	return chars
+
+def gro_names(names,width=5,left=False):
+
+	"""
+	Format residue or atom names as a justified character matrix.
+	"""
+
+	justify = np.char.ljust if left else np.char.rjust
+	padded = justify(np.asarray(names,dtype='S%d'%width),width)
+	return padded.view(np.uint8).reshape(len(padded),width)
+
+def gro_floats(values,form='%8.3f',width=8):
+
+	"""
+	Format an array of floats with a fixed-width format in a single string operation.
+	Returns a character matrix with one row per atom or None if any value overflows the column.
+	"""
+
+	values = np.asarray(values,dtype=float).reshape(len(values),-1)
+	text = (form*values.size)%tuple(values.ravel().tolist())
+	if len(text)!=values.size*width: return None
+	return np.frombuffer(text,dtype=np.uint8).reshape(len(values),values.shape[1]*width).copy()
+
+def gro_coordinates(xyz):
+
+	"""
+	Format coordinates as a character matrix which is byte-identical to dotplace.
+	Trailing zeros are blanked on the character matrix while keeping at least one decimal.
+	"""
+
+	chars = gro_floats(xyz,form='%8.3f',width=8)
+	if chars is None: return None
+	digits = chars.reshape(len(chars),-1,8)
+	trailing = np.ones(digits.shape[:2],dtype=bool)
+	for col in [7,6]:
+		trailing &= digits[:,:,col]==48
+		digits[:,:,col][trailing] = 32
+	return chars
+
+def gro_records(atoms):
+
+	"""
+	Format a block of atoms as GRO records.
+	The records are assembled in a preallocated character buffer. If any value is too large for its column
+	we fall back to formatting this block one atom at a time so the output is unchanged.
+	"""
+
+	has_velocities = 'v' in atoms.dtype.names
+	coords = gro_coordinates(atoms['xyz'])
+	velocs = gro_floats(atoms['v'],form='%8.4f',width=8) if has_velocities else None
+	if coords is None or (has_velocities and velocs is None):
+		return ''.join(['%5d%-5s%5s%5d'%(atom['resid']%100000,atom['resname'],
+			atom['atomname'],atom['index']%100000)+''.join([dotplace(x) for x in atom['xyz']])+
+			(''.join(['%8.4f'%x for x in atom['v']]) if has_velocities else '')+'\n' for atom in atoms])
+	buf = np.empty((len(atoms),45+(24 if has_velocities else 0)),dtype=np.uint8)
+	buf[:,0:5] = gro_numbers(atoms['resid'])
+	buf[:,5:10] = gro_names(atoms['resname'],left=True)
+	buf[:,10:15] = gro_names(atoms['atomname'])
+	buf[:,15:20] = gro_numbers(atoms['index'])
+	buf[:,20:44] = coords
+	if has_velocities: buf[:,44:68] = velocs
+	buf[:,-1] = 10
+	return buf.tostring()
+
+def write_gro_structure(fn,atoms,box,title='SYSTEM',chunk=100000):
+
+	"""
+	Write a structured array of atoms to a GRO file.
+	The box can be the original box line from read_gro_structure or a list of box vectors.
+	Residue and atom numbers wrap at 100000 in the same way as GROMACS. Atoms are formatted and streamed to
+	disk in blocks so that memory stays bounded for large systems. Returns the bounds of the coordinates.
+	"""
+
+	blocks = (atoms[start:start+chunk] for start in range(0,len(atoms),chunk))
+	return write_gro_blocks(fn,blocks,len(atoms),box,title=title)
+
+def write_gro_blocks(fn,blocks,natoms,box,title='SYSTEM'):
+
+	"""
+	Write a GRO file from an iterable of atom blocks so the whole structure never has to be in memory.
+	The number of atoms must be known in advance for the header. Returns the lower and upper bounds of the
+	coordinates as written to the file.
+	"""
+
+	count = 0
+	lower,upper = np.ones(3)*np.inf,np.ones(3)*-np.inf
+	with open(fn,'w') as fp:
+		fp.write('%s\n%d\n'%(title,natoms))
+		for atoms in blocks:
+			fp.write(gro_records(atoms))
+			count += len(atoms)
+			if len(atoms)==0: continue
+			written = np.round(atoms['xyz'],3)
+			lower,upper = np.min((lower,written.min(axis=0)),axis=0),np.max((upper,written.max(axis=0)),axis=0)
+		if type(box)==str: fp.write(box.rstrip('\n')+'\n')
+		else: fp.write(' '.join([dotplace(x) for x in box])+'\n')
+	if count!=natoms: raise Exception('[ERROR] wrote %d atoms to %s but expected %d'%(count,fn,natoms))
+	return lower,upper
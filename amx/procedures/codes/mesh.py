@@ -1,9 +1,6 @@
 #!/usr/bin/python
 
 from numpy import *
-import scipy
-import scipy.spatial
-import scipy.interpolate
 
 #---sklearn is causing problems on OSX
 #import sklearn
@@ -54,19 +51,34 @@ def torusnorm(pts1,pts2,vecs):
 	Compute distances between points on a torus.
 	"""
 
+	import scipy.spatial.distance
 	cd = array([scipy.spatial.distance.cdist(pts1[:,d:d+1],pts2[:,d:d+1]) for d in range(2)])
 	cd[0] -= (cd[0]>vecs[0]/2.)*vecs[0]
 	cd[1] -= (cd[1]>vecs[1]/2.)*vecs[1]
 	cd2 = linalg.norm(cd,axis=0)
 	return cd2
 
+def csr_adjacency(rows,cols,nrows):
+
+	"""
+	Compressed sparse row adjacency from pairs of row and column indices.
+	Returns the row pointers and the columns sorted by row and then by column.
+	"""
+
+	order = lexsort((cols,rows))
+	indptr = concatenate(([0],cumsum(bincount(rows,minlength=nrows)[:nrows])))
+	return indptr,cols[order]
+
 def makemesh(pts,vec,growsize=0.2,curvilinear_neighbors=10,
 	curvilinear=True,debug=False,growsize_nm=None,excise=True,areas_only=False):
 
 	"""
 	Function which computes curvature and simplex areas on a standard mesh.
+	All per-vertex quantities are computed at once from compressed sparse row (CSR) adjacency lists.
 	"""
 
+	#---scipy is slow to import so we wait until we need a mesh
+	import scipy.spatial
 	nmol = len(pts)
 	pts = pts
 	vec = vec
@@ -83,54 +95,78 @@ def makemesh(pts,vec,growsize=0.2,curvilinear_neighbors=10,
 	if debug: print "[STATUS] shape="+str(shape(ptsb))
 	dl = scipy.spatial.Delaunay(proj)
 	if debug: print "[STATUS] reclock %0.2f"%(time.time()-st);st=time.time()
-	simplices = array([a[reclock(ptsb[a])] for a in dl.simplices])
+	#---reclock every simplex at once
+	rels = ptsb[dl.simplices]-ptsb[dl.simplices].mean(axis=1)[:,newaxis]
+	clock = argsort(arctan2(rels[...,0],rels[...,1]),axis=1)[:,::-1]
+	simplices = dl.simplices[arange(len(dl.simplices))[:,newaxis],clock]
 	#---rework simplices and ptsb to exclude superfluous points
 	if debug: print "[STATUS] trim %0.2f"%(time.time()-st);st=time.time()
-	#---relevants is a unique list of simplices with exactly one member that is equal to a core vertex point
-	relevants = unique(concatenate([simplices[where(sum(simplices==i,axis=1)==1)[0]] for i in range(nmol)]))
+	#---relevants is a unique list of points in simplices with at least one core vertex point
+	relevants = unique(simplices[any(simplices<nmol,axis=1)])
 	points = ptsb[relevants]
 	ghost_indices = ptsb_inds[relevants]
 	ptsb = points
 	if debug: print "[STATUS] simplices %0.2f"%(time.time()-st);st=time.time()
-	simplices = array([[where(relevants==r)[0][0] for r in s] 
-		for s in simplices if all([r in relevants for r in s])])
+	#---remap the simplices onto the relevant points with a lookup array
+	lookup = -1*ones(len(ptsb_inds),dtype=int)
+	lookup[relevants] = arange(len(relevants))
+	simplices = lookup[simplices]
+	simplices = simplices[all(simplices>=0,axis=1)]
 	#---end rework
 	if debug: print "[STATUS] areas %0.2f"%(time.time()-st);st=time.time()
-	areas = array([triarea(ptsb[a]) for a in simplices])
+	corners = ptsb[simplices]
+	faces = cross(corners[:,1]-corners[:,0],corners[:,2]-corners[:,0])
+	areas = linalg.norm(faces,axis=1)/2.
 	if areas_only: return {'simplices':simplices,'areas':areas,'nmol':nmol,'vec':vec,'points':points}
 	if debug: print "[STATUS] facenorms %0.2f"%(time.time()-st);st=time.time()
-	facenorms = array([vecnorm(facenorm(ptsb[a])) for a in simplices])	
+	facenorms = faces/linalg.norm(faces,axis=1)[:,newaxis]
 	if debug: print "[STATUS] vertex-to-simplex %0.2f"%(time.time()-st);st=time.time()
-	v2s = [where(any(simplices==i,axis=1))[0] for i in range(nmol)]
+	#---vertex-to-simplex adjacency for the core vertices
+	simplex_ids = repeat(arange(len(simplices)),3)
+	core = simplices.ravel()<nmol
+	v2s_ptr,v2s = csr_adjacency(simplices.ravel()[core],simplex_ids[core],nmol)
+	v2s_rows = repeat(arange(nmol),diff(v2s_ptr))
 	if debug: print "[STATUS] vertex normals %0.2f"%(time.time()-st);st=time.time()
-	vertnorms = array([vecnorm(sum(facenorms[ind]*\
-		transpose([areas[ind]/sum(areas[ind])]),axis=0)) for ind in v2s])
-	principals = zeros((nmol,2))
-	nl = []
+	area_sums = bincount(v2s_rows,weights=areas[v2s],minlength=nmol)
+	vertnorms = transpose([bincount(v2s_rows,weights=facenorms[v2s,d]*areas[v2s],minlength=nmol)
+		for d in range(3)])/area_sums[:,newaxis]
+	vertnorms /= linalg.norm(vertnorms,axis=1)[:,newaxis]
 	if debug: print "[STATUS] curvatures %0.2f"%(time.time()-st);st=time.time()
-	for v in range(nmol):
-		neighbors = unique(simplices[where(any(simplices==v,axis=1))[0]])
-		neighbors = neighbors[neighbors!=v]
-		nl.append(neighbors)
-		edges = ptsb[neighbors]-ptsb[v]
-		weights = [areas[sl]/2./sum(areas[v2s[v]]) for sl in v2s[v]]
-		tijs = [vecnorm(dot(identity(3)-outer(vertnorms[v],
-			vertnorms[v].T),ab)) for ab in edges]
-		kijs = [dot(vertnorms[v].T,ab)/linalg.norm(ab)**2 for ab in edges]
-		ct = sum([weights[ind]*kijs[ind]*outer(tijs[ind],tijs[ind]) 
-			for ind,i in enumerate(v2s[v])],axis=0)
-		wsign = 1-2*(linalg.norm(array([1,0,0])+\
-			vertnorms[v])<linalg.norm(array([1,0,0])-vertnorms[v]))
-		wvi = vecnorm(array([1,0,0])+wsign*vertnorms[v])
-		hm = identity(3)-2*outer(wvi,wvi.T)
-		hhm = dot(dot(hm.T,ct),hm)
-		principals[v] = -1*hhm[1,1],-1*hhm[2,2]
+	#---vertex-to-neighbor adjacency from every ordered pair of vertices in each simplex
+	pairs = concatenate([simplices[:,[i,j]] for i in range(3) for j in range(3) if i!=j])
+	pairs = pairs[pairs[:,0]<nmol]
+	pairs = unique(pairs[:,0]*len(ptsb)+pairs[:,1])
+	nl_ptr,nl_cols = csr_adjacency(pairs//len(ptsb),pairs%len(ptsb),nmol)
+	nl = split(nl_cols,nl_ptr[1:-1])
+	#---each simplex weight is paired with the neighbor edge of the same rank for each vertex
+	nl_rank = arange(len(nl_cols))-repeat(nl_ptr[:-1],diff(nl_ptr))
+	v2s_rank = arange(len(v2s))-v2s_ptr[v2s_rows]
+	nl_rows = repeat(arange(nmol),diff(nl_ptr))
+	paired_nl = nl_rank<diff(v2s_ptr)[nl_rows]
+	paired_v2s = v2s_rank<diff(nl_ptr)[v2s_rows]
+	rows = nl_rows[paired_nl]
+	edges = ptsb[nl_cols[paired_nl]]-ptsb[rows]
+	weights = areas[v2s[paired_v2s]]/2./area_sums[rows]
+	norms = vertnorms[rows]
+	projections = einsum('ij,ij->i',norms,edges)
+	tijs = edges-norms*projections[:,newaxis]
+	tijs /= linalg.norm(tijs,axis=1)[:,newaxis]
+	kijs = projections/sum(edges**2,axis=1)
+	terms = einsum('i,ij,ik->ijk',weights*kijs,tijs,tijs).reshape(-1,9)
+	ct = transpose([bincount(rows,weights=terms[:,k],minlength=nmol) for k in range(9)]).reshape(-1,3,3)
+	#---householder transforms of the curvature tensors
+	xhat = array([1,0,0])
+	wsign = 1-2*(linalg.norm(xhat+vertnorms,axis=1)<linalg.norm(xhat-vertnorms,axis=1))
+	wvi = xhat+wsign[:,newaxis]*vertnorms
+	wvi /= linalg.norm(wvi,axis=1)[:,newaxis]
+	hm = identity(3)-2*einsum('ij,ik->ijk',wvi,wvi)
+	hhm = einsum('nji,njk,nkl->nil',hm,ct,hm)
+	principals = -1*transpose([hhm[:,1,1],hhm[:,2,2]])
 	if debug: print "[STATUS] PBC neighborlist %0.2f"%(time.time()-st);st=time.time()
-	#---neighborlist under PBCs
-	checksubssort,nlsubs = where(torusnorm(points[nmol:],points[:nmol],vec)==0)
-	#if not all(checksubssort==arange(len(points)-nmol)): raise Exception('torusnorm lookup fail')
-	try: nlpbc = [[(i if i<nmol else nlsubs[i-nmol]) for i in n] for n in nl]
-	except: nlpbc = []
+	#---neighborlist under PBCs maps each ghost point back to its core point using the ids from beyonder
+	images = (points[:,:2]-points[ghost_indices,:2])/array(vec[:2])
+	if not allclose(images,around(images),atol=1e-6): raise Exception('[ERROR] ghost lookup fail')
+	nlpbc = split(ghost_indices[nl_cols],nl_ptr[1:-1])
 	gauss = (3*principals[:,0]-principals[:,1])*(3*principals[:,1]-\
 		principals[:,0])
 	mean = 1./2*((3*principals[:,0]-principals[:,1])+\
@@ -138,4 +174,4 @@ def makemesh(pts,vec,growsize=0.2,curvilinear_neighbors=10,
 	if debug: print "[STATUS] complete %0.2f"%(time.time()-st);st=time.time()
 	return {'nmol':nmol,'vec':vec,'simplices':simplices,'points':points,
 		'areas':areas,'facenorms':facenorms,'vertnorms':vertnorms,'principals':principals,
-		'ghost_ids':ghost_indices,'gauss':gauss,'mean':mean}
+		'ghost_ids':ghost_indices,'gauss':gauss,'mean':mean,'nlpbc':nlpbc}
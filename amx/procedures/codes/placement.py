@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""
+Batched placement of lipids on a monolayer mesh.
+
+Every copy of a lipid is rotated about the monolayer axis and then tilted onto the local normal. Instead of
+building two rotation matrices per lipid we build all of them as (N,3,3) arrays and apply them with einsum.
+"""
+
+import numpy as np
+from groio import gro_atoms
+
+def rotation_matrices(axes,thetas):
+
+	"""
+	Return rotation matrices for many axes and angles at once using the Euler-Rodrigues formula.
+	This matches rotation_matrix in the bilayer procedures, including the identity for a zero axis.
+	"""
+
+	axes = np.array(axes,dtype=float).reshape(-1,3)
+	thetas = np.array(thetas,dtype=float)*np.ones(len(axes))
+	lengths = np.sqrt(np.sum(axes**2,axis=1))
+	nonzero = lengths>0
+	axes[nonzero] /= lengths[nonzero][:,np.newaxis]
+	a = np.cos(thetas/2)
+	b,c,d = (-axes*np.sin(thetas/2)[:,np.newaxis]).T
+	aa,bb,cc,dd = a*a,b*b,c*c,d*d
+	bc,ad,ac,ab,bd,cd = b*c,a*d,a*c,a*b,b*d,c*d
+	rots = np.transpose([[aa+bb-cc-dd,2*(bc+ad),2*(bd-ac)],[2*(bc-ad),aa+cc-bb-dd,2*(cd+ab)],
+		[2*(bd+ac),2*(cd-ab),aa+dd-bb-cc]],(2,0,1))
+	rots[~nonzero] = np.identity(3)
+	return rots
+
+def place_lipids(lpts,points,normals,zvec,angles=None):
+
+	"""
+	Place one copy of a lipid at each point.
+	Each copy is rotated about zvec by the corresponding angle (if any) and then rotated onto the normal with
+	the same axis and angle as the original build_bilayer. The result is flipped along zvec so that the lower
+	monolayer points down. Returns an (N,natoms,3) array.
+	"""
+
+	zvec = np.array(zvec,dtype=float)
+	normals = np.asarray(normals)
+	tilts = rotation_matrices(np.cross(zvec,normals),np.dot(normals,zvec))
+	if angles is not None:
+		tilts = np.einsum('nij,njk->nik',tilts,rotation_matrices(np.tile(zvec,(len(angles),1)),angles))
+	sign = 1 if zvec[2]>=0 else -1
+	return np.asarray(points)[:,np.newaxis,:]+sign*np.einsum('nij,aj->nai',tilts,lpts)
+
+def placed_lipid_blocks(lipids,lipid_order,identities,ptsmid,meshes,mono_offset,
+	random_rotation=True,chunk=None,progress=None):
+
+	"""
+	Place the lipids on both monolayers and yield them as blocks of GRO atoms.
+	Lipids are grouped by type in the order of lipid_order and then by monolayer. Each block holds at most
+	chunk lipids (or every lipid of one type on one monolayer if chunk is None) so that memory use does not
+	grow with the size of the membrane. Residue and atom numbers continue across blocks.
+	"""
+
+	resnr = 1
+	for lipid_num,lipid in enumerate(lipid_order):
+		lpts,atomnames = lipids[lipid]['lpts'],lipids[lipid]['atomnames']
+		for mn in range(2):
+			zvec = np.array([0,0,1]) if mn==0 else np.array([0,0,-1])
+			indices = np.where(identities[mn]==lipid_num)[0]
+			size = chunk if chunk else max(len(indices),1)
+			for block_num,block in enumerate(range(0,len(indices),size)):
+				if progress: 
+					progress('placing %s'%lipid,i=block_num,looplen=int(np.ceil(len(indices)/float(size))))
+				subset = indices[block:block+size]
+				normals = meshes[mn]['vertnorms'][subset]
+				angles = np.random.uniform(size=len(subset))*2*np.pi if random_rotation else None
+				xyz = place_lipids(lpts,ptsmid[mn][subset]+[1,-1][mn]*mono_offset*normals,
+					normals,zvec,angles=angles)
+				atoms = gro_atoms(xyz.shape[0]*xyz.shape[1])
+				resids = resnr+np.repeat(np.arange(len(subset)),len(lpts))
+				atoms['resid'] = resids
+				atoms['resname'] = lipid
+				atoms['atomname'] = np.tile(atomnames,len(subset))
+				atoms['index'] = (resids-1)*len(lpts)+np.tile(np.arange(len(lpts)),len(subset))+1
+				atoms['xyz'] = xyz.reshape(-1,3)
+				resnr += len(subset)
+				yield atoms
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+"""
+Binary cache for molecule templates.
+
+Bilayer builds read the same lipid structures over and over. The parsed atoms for every template are kept in
+a single npz file alongside the SHA1 hash of the source GRO file so that a template is only parsed again when
+it changes.
+"""
+
+import os,hashlib
+import numpy as np
+from groio import read_gro_structure
+
+#---default name of the cache file which sits next to the templates
+template_cache_name = 'template-cache.npz'
+
+def template_key(fn,center=False):
+
+	"""
+	Name of a template in the cache which is unique to its real path so that links to the same file (for
+	example the inputs folder of each ensemble member) share one entry.
+	"""
+
+	name = os.path.splitext(os.path.basename(fn))[0]
+	return '%s-%s%s'%(name,hashlib.sha1(os.path.realpath(fn)).hexdigest()[:8],'-centered' if center else '')
+
+def load_template(fn,center=False,cache=None):
+
+	"""
+	Return the atoms in a GRO template from the binary cache.
+	The cache defaults to a file next to the template. Centered templates are shifted to their centroid. If the
+	template is missing from the cache or its source has changed we parse it and rewrite the cache. A cache
+	that cannot be read for any reason (including a truncated archive) is rebuilt and one that cannot be
+	written is ignored.
+	"""
+
+	with open(fn,'rb') as fp: digest = hashlib.sha1(fp.read()).hexdigest()
+	if not cache: cache = os.path.join(os.path.dirname(fn),template_cache_name)
+	key = template_key(fn,center=center)
+	entries = {}
+	if os.path.isfile(cache):
+		try:
+			stored = np.load(cache)
+			try:
+				if key+'.sha1' in stored.files and str(stored[key+'.sha1'])==digest:
+					return stored[key+'.atoms']
+				entries = dict([(i,stored[i]) for i in stored.files])
+			finally: stored.close()
+		except Exception: entries = {}
+	atoms = read_gro_structure(fn)['atoms']
+	if center: atoms['xyz'] = atoms['xyz']-atoms['xyz'].mean(axis=0)
+	entries[key+'.atoms'] = atoms
+	entries[key+'.sha1'] = np.array(digest)
+	#---each process writes its own temporary file and moves it into place so readers never see a partial cache
+	temporary = cache+'.tmp%d.npz'%os.getpid()
+	try:
+		np.savez(temporary,**entries)
+		os.rename(temporary,cache)
+	except (IOError,OSError):
+		if os.path.isfile(temporary): os.remove(temporary)
+	return atoms
@@ -15,6 +15,7 @@ from amx.base.functions import filecopy
 from amx.base.gmxwrap import gmx,gmx_run,checkpoint
 from amx.base.gromacs import gmxpaths
 from amx.base.journal import narrate,report
+from amx.base.stages import stage
 from amx.base.tools import detect_last
 import shutil,glob
 
@@ -57,67 +58,54 @@ def component(name,count=None,top=False):
 	return wordspace['composition'][names.index(name)][1]
 
 @narrate
-def get_box_vectors(structure,gro=None,d=0,log='checksize'):
+def get_box_vectors(structure,gro=None,d=0,log='checksize',extent=True):
 
 	"""
 	Return the box vectors.
-	"""
-
-	if not gro: gro = structure+'-check-box'
-	#---note that we consult the command_library here
-	gmx('editconf',structure=structure,gro=gro,
-		log='editconf-%s'%log,flag='-d %d'%d)
-	with open(wordspace['step']+'log-editconf-%s'%log,'r') as fp: lines = fp.readlines()
-	box_vector_regex = '\s*box vectors\s*\:\s*([^\s]+)\s+([^\s]+)\s+([^\s]+)'
-	box_vector_new_regex = '\s*new box vectors\s*\:\s*([^\s]+)\s+([^\s]+)\s+([^\s]+)'
-	runon_regex = '^\s*([-]?[0-9]+\.?[0-9]{0,3})\s*([-]?[0-9]+\.?[0-9]{0,3})\s*([-]?[0-9]+\.?[0-9]{0,3})'
-	old_line = [l for l in lines if re.match(box_vector_regex,l)][0]
-	vecs_old = re.findall('\s*box vectors\s*:([^\(]+)',old_line)[0]
-	try:
-		#---sometimes the numbers run together
-		try: vecs_old = [float(i) for i in vecs_old.strip(' ').split()]
-		except: vecs_old = [float(i) for i in re.findall(runon_regex,vecs_old)[0]]
-		#---repeat for new box vectors
-		new_line = [l for l in lines if re.match(box_vector_new_regex,l)][0]
-		vecs_new = re.findall('\s*box vectors\s*:([^\(]+)',new_line)[0]
-		try: vecs_new = [float(i) for i in vecs_new.strip(' ').split()]
-		except: vecs_new = [float(i) for i in re.findall(runon_regex,vecs_new)[0]]
-	except:
-		import pdb;pdb.set_trace()
-	#---no need to keep the output since it is a verbatim copy for diagnostic only
-	os.remove(wordspace['step']+gro+'.gro')
-	#import pdb;pdb.set_trace()
+	This reproduces the box vectors reported by editconf without running it. The old vectors come from the 
+	last line of the structure, which is read from the end of the file. The new vectors are the extent of the 
+	coordinates padded by d on each side, which is what editconf -d reports for a rectangular box. Both are
+	rounded to the precision of the editconf log. Set extent to False if only the old vectors are needed so
+	that the coordinates are never read (the new vectors are then None). The gro and log arguments are 
+	retained for compatibility.
+	"""
+
+	from amx.procedures.codes.groio import read_gro_box,gro_box_lengths,read_gro_extent
+	fn = wordspace['step']+structure+'.gro'
+	vecs_old = [round(float(i),3) for i in gro_box_lengths(read_gro_box(fn))]
+	if not extent: return vecs_old,None
+	vecs_new = [round(float(i)+2*d,3) for i in read_gro_extent(fn)]
 	return vecs_old,vecs_new
 
 @narrate
 def count_molecules(structure,resname):
 
 	"""
-	Count the number of molecules in a system using make_ndx.
+	Count the number of molecules in a system.
+	Returns the number of atoms with this residue name, which is the size of the group that make_ndx reports.
 	"""
 
-	gmx('make_ndx',structure=structure,ndx=structure+'-count',
-		log='make-ndx-%s-check'%structure,inpipe='q\n')
-	with open(wordspace['step']+'log-make-ndx-%s-check'%structure) as fp: lines = fp.readlines()
-	try:
-		residue_regex = '^\s*[0-9]+\s+%s\s+\:\s+([0-9]+)\s'%resname
-		count, = [int(re.findall(residue_regex,l)[0]) for l in lines if re.match(residue_regex,l)]
-	except: raise Exception('cannot find resname "%s" in %s'%(resname,'make-ndx-%s-check'%structure))
-	return count
+	from amx.procedures.codes.groio import count_residues
+	counts = count_residues(wordspace['step']+structure+'.gro')
+	if resname not in counts: raise Exception('cannot find resname "%s" in %s'%(resname,structure))
+	return counts[resname]['atoms']
 	
 @narrate
 def trim_waters(structure='solvate-dense',gro='solvate',
-	gap=3,boxvecs=None,method='aamd',boxcut=True):
+	gap=3,boxvecs=None,method='aamd',boxcut=True,backend=None,pbc=True):
 
 	"""
 	trim_waters(structure='solvate-dense',gro='solvate',gap=3,boxvecs=None)
 	Remove waters within a certain number of Angstroms of the protein.
 	#### water and all (water and (same residue as water within 10 of not water))
 	note that we vided the solvate.gro as a default so this can be used with any output gro file
+	The backend is either scipy or vmd and defaults to vmd only if use_vmd is set in the wordspace. The scipy
+	backend measures the gap across periodic images of a rectangular box unless pbc is False.
 	"""
 
-	use_vmd = wordspace.get('use_vmd',False)
-	if (gap != 0.0 or boxcut) and use_vmd:
+	if not backend: backend = 'vmd' if wordspace.get('use_vmd',False) else 'scipy'
+	if backend not in ['vmd','scipy']: raise Exception('[ERROR] unclear trim_waters backend %s'%backend)
+	if (gap != 0.0 or boxcut) and backend=='vmd':
 		if method == 'aamd': watersel = "water"
 		elif method == 'cgmd': watersel = "resname %s"%wordspace.sol
 		else: raise Exception("\n[ERROR] unclear method %s"%method)
@@ -151,66 +139,43 @@ def trim_waters(structure='solvate-dense',gro='solvate',
 		import scipy
 		import scipy.spatial
 		import numpy as np
+		from amx.procedures.codes.groio import write_gro_structure,residue_starts
 		#---if "sol" is not in the wordspace we assume this is atomistic and use the standard "SOL"
 		watersel = wordspace.get('sol','SOL')
 		incoming = read_gro(structure+'.gro')
-		#---remove waters that are near not-waters
-		is_water = np.array(incoming['residue_names'])==watersel
-		is_not_water = np.array(incoming['residue_names'])!=watersel
-		water_inds = np.where(is_water)[0]
-		not_water_inds = np.where(np.array(incoming['residue_names'])!=watersel)[0]
-		points = np.array(incoming['points'])
-		residue_indices = np.array(incoming['residue_indices'])
-		if gap>0:
-			#---previous method used clumsy/slow cdist
-			if False:
-				#---! needs KDTree optimization
-				dists = scipy.spatial.distance.cdist(points[water_inds],points[not_water_inds])
-				#---list of residue indices in is_water that have at least one atom with an overlap
-				excludes = np.array(incoming['residue_indices'])[is_water][
-					np.where(np.any(dists<=gap/10.0,axis=1))[0]]
-				#---collect waters not found in the excludes list of residues that overlap with not-water
-				#---note that this command fails on redundant residues
-				#---this was deprecated because it wasn't working correctly with the new KDTree method below
-				surviving_water = np.all((np.all((
-					np.tile(excludes,(len(residue_indices),1))!=np.tile(residue_indices,(len(excludes),1)).T),
-					axis=1),is_water),axis=0)
-			#---use scipy KDTree to find atom names inside the gap
-			#---note that order matters: we wish to find waters too close to not_waters
-			close_dists,neighbors = scipy.spatial.KDTree(points[water_inds]).query(points[not_water_inds],distance_upper_bound=gap/10.0)
-			#---use the distances to find the residue indices for waters that are too close 
-			excludes = np.array(incoming['residue_indices'])[is_water][np.where(close_dists<=gap/10.0)[0]]
-			#---get residues that are water and in the exclude list
-			#---note that the following step might be slow
-			exclude_res = [ii for ii,i in enumerate(incoming['residue_indices']) if i in excludes and is_water[ii]]
-			#---copy the array that marks the waters
-			surviving_water = np.array(is_water)
-			#---remove waters that are on the exclude list
-			surviving_water[exclude_res] = False
-		else: 
-			excludes = np.array([])
-			surviving_water = np.ones(len(residue_indices)).astype(bool)
+		atoms = incoming['atoms']
+		points = incoming['points']
+		is_water = atoms['resname']==watersel
+		#---number residues in order since residue numbers wrap in large systems
+		residues = np.cumsum(residue_starts(atoms))-1
+		excludes = np.zeros(len(atoms),dtype=bool)
+		if gap>0 and np.any(is_water) and not np.all(is_water):
+			#---find waters with any atom within the gap of a not-water atom
+			box = incoming['box']
+			periodic = pbc and len(box)>=3 and np.all(box[:3]>0) and (len(box)==3 or np.all(box[3:]==0))
+			if periodic:
+				box = box[:3]
+				wrapped = np.mod(points,box)
+				wrapped[wrapped>=box] = 0.0
+				tree = scipy.spatial.cKDTree(wrapped[~is_water],boxsize=box)
+				close_dists,_ = tree.query(wrapped[is_water],distance_upper_bound=gap/10.0)
+			else: 
+				tree = scipy.spatial.cKDTree(points[~is_water])
+				close_dists,_ = tree.query(points[is_water],distance_upper_bound=gap/10.0)
+			#---exclude the whole residue for any water atom that is too close
+			close = np.where(is_water)[0][close_dists<=gap/10.0]
+			excludes |= np.isin(residues,np.unique(residues[close]))
 		#---we must remove waters that lie outside the box if there is a boxcut
-		insiders = np.ones(len(points)).astype(bool)
 		if boxcut:
-			#---remove waters that lie outside the box
-			#---get points that are outside of the box
-			outsiders = np.any([np.any((points[:,ii]<0,points[:,ii]>i),axis=0) 
-				for ii,i in enumerate(boxvecs)],axis=0)
-			#---get residue numbers for the outsiders
-			outsiders_res = np.array(incoming['residue_indices'])[np.where(outsiders)[0]]
-			#---note that this is consonant with the close-water exclude step above (and also may be slow)
-			exclude_outsider_res = [ii for ii,i in 
-				enumerate(incoming['residue_indices']) if i in outsiders_res]
-			insiders[exclude_outsider_res] = False
-		surviving_indices = np.any((is_not_water,np.all((surviving_water,insiders),axis=0)),axis=0)
-		lines = incoming['lines']
-		lines = lines[:2]+list(np.array(incoming['lines'][2:-1])[surviving_indices])+lines[-1:]
-		xyzs = list(points[surviving_indices])
-		write_gro(lines=lines,xyzs=xyzs,output_file=wordspace.step+'%s.gro'%gro)
+			outsiders = np.any((points<0,points>np.array(boxvecs)[:3]),axis=(0,2))
+			excludes |= np.isin(residues,np.unique(residues[outsiders]))
+		surviving_indices = np.any((~is_water,~excludes),axis=0)
+		write_gro_structure(wordspace.step+'%s.gro'%gro,atoms[surviving_indices],
+			box=incoming['box_line'],title=incoming['title'])
 	else: filecopy(wordspace['step']+'%s-dense.gro'%gro,wordspace['step']+'%s.gro'%gro)
 
 @narrate
+@stage
 def minimize(name,method='steep',top=None):
 
 	"""
@@ -290,6 +255,7 @@ def equilibrate_check(name):
 	return found
 
 @narrate
+@stage
 def equilibrate(groups=None,structure='system'):
 
 	"""
@@ -321,6 +287,7 @@ def equilibrate(groups=None,structure='system'):
 		checkpoint()
 
 @narrate
+@stage
 def counterions(structure,top,includes=None,ff_includes=None,gro='counterions'):
 
 	"""
@@ -448,49 +415,43 @@ def read_gro(gro,**kwargs):
 
 	"""
 	Read a GRO file and return its XYZ coordinates and atomnames. 
-	!Note that this is highly redundant with a cgmd_bilayer.read_molecule so you might replace that one.
-	!RE-ADD NUMPY AND CENTER FOR reionize/cgmd_bilayer
+	The columns are parsed by the shared reader in codes.groio and the structured array of atoms is 
+	included under the "atoms" key.
 	!Note that we drop velocities which should be read separately or with a flag.
 	"""
 
+	from amx.procedures.codes.groio import read_gro_structure
 	step = kwargs.get('step',wordspace.step)
 	center = kwargs.get('center',False)
-	with open(step+gro,'r') as fp: lines = fp.readlines()
-	if center:
-		import numpy as np
-		pts = np.array([[float(j) for j in i.strip('\n')[20:].split()] for i in lines[2:-1]])
-		pts -= np.mean(pts,axis=0)
-		atom_names = np.array([i.strip('\n')[10:15].strip(' ') for i in lines[2:-1]])
-	else:
-		try: pts = [[float(j) for j in i.strip('\n')[20:].split()] for i in lines[2:-1]]
-		#---backup regex in case values run together
-		except: 
-			runon_regex = \
-				'^\s*([-]?[0-9]+\.?[0-9]{0,3})\s*([-]?[0-9]+\.?[0-9]{0,3})\s*([-]?[0-9]+\.?[0-9]{0,3})'
-			pts = [[float(j) for j in re.findall(runon_regex,i[20:])[0]] for i in lines[2:-1]]
-		atom_names = [i.strip('\n')[10:15].strip(' ') for i in lines[2:-1]]
-	residue_names = [i[5:10].strip() for i in lines[2:-1]]
-	residue_indices = [int(i[0:5].strip()) for i in lines[2:-1]]
-	outgoing = {'points':[i[:3] for i in pts],'atom_names':atom_names,'lines':lines,
-		'residue_names':residue_names,'residue_indices':residue_indices}
+	incoming = read_gro_structure(step+gro,velocities=kwargs.get('velocities',False))
+	atoms = incoming['atoms']
+	pts = atoms['xyz']
+	if center: pts = pts-pts.mean(axis=0)
+	outgoing = {'points':pts,'atom_names':atoms['atomname'],'atoms':atoms,
+		'residue_names':atoms['resname'],'residue_indices':atoms['resid'],
+		'title':incoming['title'],'box':incoming['box'],'box_line':incoming['box_line']}
 	return outgoing
 
 def write_gro(**kwargs):
 
 	"""
 	Write a GRO file with new coordinates.
+	The coordinates are formatted in one pass by the bulk formatter in codes.groio.
 	"""
 
-	dotplace = lambda n: re.compile(r'(\d)0+$').sub(r'\1',"%8.3f"%float(n)).ljust(8)	
+	from amx.procedures.codes.groio import gro_coordinates,dotplace
 	input_file = kwargs.get('input_file',None)
 	output_file = kwargs.get('output_file',None)
 	if input_file:
-		with open(incoming,'r') as fp: lines = fp.readlines()
+		with open(input_file,'r') as fp: lines = fp.readlines()
 	else: lines = kwargs.get('lines')
 	xyzs = kwargs.get('xyzs')
 	lines[1] = re.sub('^\s*([0-9]+)','%d'%(len(lines)-3),lines[1])
+	coords = gro_coordinates(xyzs)
+	if coords is None: coords = [''.join([dotplace(x) for x in xyz]) for xyz in xyzs]
+	else: coords = coords.view('S%d'%coords.shape[1]).ravel()
 	for lnum,line in enumerate(lines[2:-1]):
-		lines[2+lnum] = line[:20] + ''.join([dotplace(x) for x in xyzs[lnum]])+'\n'
+		lines[2+lnum] = line[:20]+coords[lnum]+'\n'
 	with open(output_file,'w') as fp: 
 		for line in lines: fp.write(line)
 
@@ -538,11 +499,12 @@ def autodetect_start_structure():
 	"""
 	Autodetect a lone PDB file in the inputs folder if the user has not changed the default "start_structure"
 	setting. This function is useful for starting batches of protein simulations or homology modeling in 
-	e.g. the factory codes.
+	e.g. the factory codes. Many structures are run with "make protein_batch", which gives each one its own
+	project folder and sets the start_structure for each.
 	"""
-        
-        if wordspace.requires=='homology':
-                wordspace.start_structure=wordspace.template
+
+	if wordspace.requires=='homology':
+		wordspace.start_structure=wordspace.template
 	if not 'start_structure' in wordspace: 
 		raise Exception('\n[ERROR] this autodect function requires the start_structure setting\n'+
 			'[ERROR] (set start_structure to inputs/STRUCTURE.pdb to autodetect a lone pdb in inputs.')
@@ -550,13 +512,19 @@ def autodetect_start_structure():
 		pdbs = glob.glob('inputs/*.pdb')
 		if len(pdbs)==1: 
 			wordspace.start_structure = pdbs[0]
-                        wordspace.system_name = re.findall('^inputs/([\w\.-]+)\.pdb$',pdbs[0])[0]
+			wordspace.system_name = re.findall('^inputs/([\w\.-]+)\.pdb$',pdbs[0])[0]
 		else: 
 			if 'watch_file' not in wordspace: wordspace.watch_file = 'ERROR.log'
 			report('multiple PDBs in inputs/ and start_structure is still default',tag='warning')
-	else:
-		print "OOPS"
-		import pdb;pdb.set_trace()
+			report('use "make protein_batch inputs" to simulate each of them',tag='note')
+	elif os.path.isdir(wordspace.start_structure) or re.search('[\*\?\[]',wordspace.start_structure):
+		raise Exception('[ERROR] start_structure "%s" names many structures: '%wordspace.start_structure+
+			'use "make protein_batch %s" to run one simulation for each'%(wordspace.start_structure 
+			if os.path.isdir(wordspace.start_structure) else 'structures="%s"'%wordspace.start_structure))
+	#---an explicit structure names the system unless the user has already named it
+	elif os.path.isfile(wordspace.start_structure) and wordspace.get('system_name','SYSTEM')=='SYSTEM':
+		wordspace.system_name = re.sub('[^\w\.-]','_',
+			os.path.splitext(os.path.basename(wordspace.start_structure))[0])
 
 def autodetect_protein_itp(single=True):
 
@@ -37,6 +37,32 @@ def get_timings():
 		with open('timings.py','w') as fp: fp.write(str(performances))
 		print instructions
 
+def tune_mdrun(tpr=None,nprocs=None,nsteps=4000,pme='auto:0:2:4',nstlist='auto',dry=False):
+
+	"""
+	Time short mdrun trials on a TPR and store the fastest launch flags for this machine.
+	The trials cover thread-MPI ranks, OpenMP threads and PME ranks (pme) within nprocs (from the machine
+	configuration by default). Neighbor list intervals (nstlist) are only reported since they belong in the
+	MDP parameters. Separate choices with colons. The result is used by every later mdrun with the same nprocs
+	on this machine. Use dry to list the trials. See amx/base/tuner.py for details.
+	"""
+
+	import sys,subprocess
+	if not tpr: 
+		print '[USAGE] make tune_mdrun <tpr> (nprocs=<n>) (nsteps=<n>) (pme=auto:0:2) (nstlist=auto:40) (dry)'
+		return
+	#---the tuner needs amx so it runs from a temporary script like benchmark_import
+	script = 'script-tune-mdrun.py'
+	if os.path.isfile(script): raise Exception('[ERROR] %s is in the way'%script)
+	with open(script,'w') as fp: 
+		fp.write('\n'.join(['settings = """','step: tune','requires: common','"""',
+			'from amx.base.tuner import run_tuner',
+			'run_tuner(%r,nprocs=%r,nsteps=%r,pme=%r,nstlist=%r,dry=%r)'%(
+			tpr,nprocs,int(nsteps),pme,nstlist,bool(dry)),'']))
+	try: 
+		if subprocess.call([sys.executable,script])!=0: raise Exception('[ERROR] tuning failed')
+	finally: os.remove(script)
+
 def plot_benchmarks():
 
 	"""
@@ -120,3 +146,36 @@ def plot_benchmarks():
 		plt.close()
 		with open('inputs/benchmarks-%s.csv'%shortname,'w') as fp: fp.write(text)
 		print '[STATUS] wrote inputs/benchmarks-%s.png and inputs/benchmarks-%s.csv'%(shortname,shortname)
+
+def benchmark_import(procedures='common,bilayer,cgmd_bilayer,protein_atomistic,reionize',
+	repeats=5,limit=0.5):
+
+	"""
+	Time "from amx import *" for scripts which require each procedure and fail if any is slower than limit.
+	Each import runs in a fresh interpreter and we report the fastest of several repeats to reduce noise.
+	Run "make benchmark_import" after changes to amx/__init__.py or the procedure imports.
+	"""
+
+	import re,os,sys,subprocess
+	script = 'script-benchmark-import.py'
+	if os.path.isfile(script): raise Exception('[ERROR] %s is in the way'%script)
+	#---amx exports many names so we keep the clock in names that it does not use
+	template = '\n'.join(['settings = """','step: benchmark','requires: %s','"""',
+		'import time as benchmark_clock','benchmark_start = benchmark_clock.time()','from amx import *',
+		'print "[TIMING] %%f"%%(benchmark_clock.time()-benchmark_start)',''])
+	slow = []
+	try:
+		for procedure in procedures.split(','):
+			with open(script,'w') as fp: fp.write(template%procedure)
+			timings = []
+			for rr in range(int(repeats)):
+				out = subprocess.Popen([sys.executable,script],stdout=subprocess.PIPE,
+					stderr=subprocess.STDOUT).communicate()[0]
+				if not re.search('^\[TIMING\] ([0-9.]+)',out,re.M): 
+					raise Exception('[ERROR] failed to import amx for %s:\n%s'%(procedure,out))
+				timings.append(float(re.search('^\[TIMING\] ([0-9.]+)',out,re.M).group(1)))
+			print '[STATUS] import with requires %s: %.3fs'%(procedure,min(timings))
+			if min(timings)>float(limit): slow.append(procedure)
+	finally: 
+		if os.path.isfile(script): os.remove(script)
+	if slow: raise Exception('[ERROR] importing amx takes more than %ss for %s'%(limit,', '.join(slow)))
@@ -1,13 +1,16 @@
 #!/usr/bin/python
 
-import re,os,subprocess
+import re,os,subprocess,itertools
 from copy import deepcopy
 from amx import wordspace
-from amx.base.functions import filecopy,resume
+from amx.base.functions import filecopy,resume,store_agrees
+from amx.base.store import stored_value
 from amx.base.gmxwrap import gmx,gmx_run,checkpoint
 from amx.base.gromacs import gmxpaths
 from amx.base.journal import *
 from amx.procedures.common import *
+from amx.procedures.codes.groio import read_gro_structure
+import numpy as np
 
 #---multiply is set to follow cgmd_bilayer however this can be changed
 from amx.procedures.cgmd_bilayer import command_library
@@ -27,7 +30,14 @@ def multiply(nx=1,ny=1,nz=1,quirky_ions=True):
 	for prereq in ['composition','lipids','cation','anion','protein_ready']:
 		if prereq not in wordspace:
 			steplist = detect_last(steplist=True)[::-1]
-			#---walk backwards through steps until we find the commposition
+			#---the indexed store finds the latest step with the key in one query
+			#---only the newest steps whose store agrees with their logs are searched this way
+			trusted = list(itertools.takewhile(store_agrees,steplist))
+			found,value = stored_value(prereq,steps=trusted)
+			if found:
+				wordspace[prereq] = deepcopy(value)
+				continue
+			#---otherwise walk backwards through steps until we find the commposition
 			for ii,i in enumerate(steplist):
 				oldspace = resume(read_only=True,step=int(re.match('s([0-9]+)-',i).group(1)))
 				if prereq in oldspace:
@@ -43,41 +53,28 @@ def multiply(nx=1,ny=1,nz=1,quirky_ions=True):
 	for itp in wordspace.itp:
 		filecopy(wordspace.last_step+itp,wordspace.step+itp)
 	#---reorder the GRO for convenience
-	with open(wordspace['step']+'system-multiply.gro') as fp: lines = fp.readlines()
-	#---collect all unique resiue/atom combinations
-	combos = list(set([l[5:15] for l in lines]))
-
-	#---for each element in the composition, extract all of the residues for that element
-	lines_reorder = []
-	lines_reorder.extend(lines[:2])
-	#---develop a list of filtering rules
-	keylist = {}
+	incoming = read_gro_structure(wordspace['step']+'system-multiply.gro',raw=True)
+	atoms,records = incoming['atoms'],incoming['records']
+	#---for each element in the composition, extract the indices of all of the residues for that element
+	order = []
 	for key,count in wordspace['new_composition']:
 		if key in [wordspace[i] for i in ['anion','cation']]:
-			keylist[key] = 'regex',(('ION',key),slice(5,15),'\s*%s\s*%s\s*')
+			order.append(np.where(np.all((atoms['resname']=='ION',atoms['atomname']==key),axis=0))[0])
 		elif re.match('^(p|P)rotein',key) and key+'.itp' in wordspace.itp:
 			#---custom procedure for finding proteins which have variegated residue numbers
 			itp = read_itp(wordspace.step+key+'.itp')
-			residues_starts = []
-			seq = list(zip(*itp['atoms'])[3])
-			residues = [i[5:10].strip() for i in lines]
-			for i in range(len(residues)-len(seq)):
-				#---minor speed up by checking the first one
-				if seq[0]==residues[i] and residues[i:i+len(seq)]==seq: 
-					residues_starts.append(i)
-			keylist[key] = 'slices',[slice(i,i+len(seq)) for i in residues_starts]
-		else: keylist[key] = 'regex',(key,slice(5,10),'\s*%s\s*')
-	for key,count in wordspace['new_composition']:
-		method,details = keylist[key]
-		if method == 'regex':
-			key,sl,regex = details
-			lines_reorder.extend([l for l in lines[2:-1] if re.match(regex%key,l[sl])])	
-		elif method == 'slices':
-			for sl in details: lines_reorder.extend(lines[sl])	
-		else: raise
-	lines_reorder.extend([lines[-1]])
+			seq = np.array(zip(*itp['atoms'])[3])
+			residues = atoms['resname']
+			#---minor speed up by checking the first one
+			residues_starts = [i for i in np.where(residues[:len(residues)-len(seq)+1]==seq[0])[0]
+				if np.all(residues[i:i+len(seq)]==seq)]
+			order.extend([np.arange(i,i+len(seq)) for i in residues_starts])
+		else: order.append(np.where(atoms['resname']==key)[0])
+	order = np.concatenate(order)
 	with open(wordspace['step']+'system-multiply-reorder.gro','w') as fp: 
-		for line in lines_reorder: fp.write(line)
+		fp.write('%s\n%d\n'%(incoming['title'],len(order)))
+		for i in order: fp.write(records[i]+'\n')
+		fp.write(incoming['box_line']+'\n')
 
 	filecopy(wordspace['step']+'system-multiply-reorder.gro',wordspace['step']+'system.gro')
 	wordspace['composition'] = tuple(wordspace['new_composition'])
@@ -6,6 +6,7 @@ from amx.base.functions import filecopy
 from amx.base.gmxwrap import gmx,gmx_run,checkpoint
 from amx.base.gromacs import gmxpaths
 from amx.base.journal import *
+from amx.base.stages import stage
 from amx.procedures.common import *
 
 """
@@ -91,6 +92,7 @@ def select_minimum(*args,**kwargs):
 	filecopy(wordspace['step']+'em-'+arg+'.gro',wordspace['step']+gro+'.gro')
 
 @narrate
+@stage
 def minimize_steep_cg(name):
 
 	"""
@@ -112,6 +114,7 @@ def minimize_steep_cg(name):
 	checkpoint()
 
 @narrate
+@stage
 def solvate(structure,top):
 
 	"""
@@ -142,11 +145,11 @@ def solvate(structure,top):
 		trim_waters(structure='solvate-dense',gro='solvate',
 			gap=wordspace['protein_water_gap'],boxvecs=boxvecs)
 	else: filecopy(wordspace['step']+'solvate-dense.gro',wordspace['step']+'solvate.gro')
-	gmx('make_ndx',structure='solvate',ndx='solvate-water-check',inpipe='q\n',
-		log='make-ndx-solvate-check')
-	with open(wordspace['step']+'log-make-ndx-solvate-check','r') as fp: lines = fp.readlines()
-	nwaters = int(re.findall('\s*[0-9]+\s+Water\s+:\s+([0-9]+)\s+atoms',
-		filter(lambda x:re.match('\s*[0-9]+\s+Water',x),lines).pop()).pop())/3
+	#---count atoms in the water group as make_ndx would and divide by the three atoms per water
+	from amx.procedures.codes.groio import count_residues,water_resnames
+	counts = count_residues(wordspace['step']+'solvate.gro')
+	if not any([i in counts for i in water_resnames]): raise Exception('[ERROR] no water in solvate.gro')
+	nwaters = sum([counts[i]['atoms'] for i in water_resnames if i in counts])/3
 	wordspace['water_without_ions'] = nwaters
 	component('SOL',count=nwaters)
 	#---add the suffix so that water is referred to by its name in the settings
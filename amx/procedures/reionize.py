@@ -8,6 +8,7 @@ from amx.base.gromacs import gmxpaths
 from amx.base.journal import *
 from amx.procedures.common import *
 import numpy as np
+from amx.procedures.codes.groio import read_gro_structure
 
 command_library = """
 grompp -f MDP.mdp -c STRUCTURE.gro -p TOP.top -o BASE.tpr -po BASE.mdp
@@ -53,8 +54,10 @@ def identify_candidate_replacements(structure,gro,top):
 	For expedience, we only perform the custom reionization desired here.
 	"""
 
-	#---read the structure
-	points,atom_names,lines = read_gro(structure)
+	#---read the structure and keep the original records for rewriting
+	incoming = read_gro_structure(wordspace.step+structure,raw=True)
+	atom_names = incoming['atoms']['atomname']
+	records = incoming['records']
 	#---read the topology
 	read_top(wordspace.step+top)
 		
@@ -80,20 +83,22 @@ def identify_candidate_replacements(structure,gro,top):
 				disappear = sorted(random.sample(candidates_for_replace,remove_quantity))
 				#---change ion types here and write the new structure
 				for change in disappear[:quantity]:
-					line = list(lines[2+change])
+					line = list(records[change])
 					#---here we use the name-name convention instead of the "ION" residue name
 					line[5:10] = transformed.ljust(5)
 					line[10:15] = transformed.rjust(5)
-					lines[2+change] = ''.join(line)
 					#---copy the line to the end
-					lines.insert(-1,lines[2+change])
-				for change in disappear[::-1]: lines.pop(2+change)
+					records.append(''.join(line))
+				for change in disappear[::-1]: records.pop(change)
+				#---keep the atom names aligned with the records for the next substitution
+				atom_names = np.delete(np.concatenate((atom_names,[transformed]*quantity)),disappear)
 				component(targets,count=component(targets)-remove_quantity)
 				component(transformed,count=quantity)
-				#---in case we have fewer total atoms in the system we update the count here
-				lines[1] = '%s\n'%(len(lines)-3)
 		else: raise Exception('cannot understand reionize_procedure: %s in reionize_specify'%procedure)
 	#---write the structure
-	with open(wordspace.step+gro+'.gro','w') as fp: fp.write(''.join(lines))
+	with open(wordspace.step+gro+'.gro','w') as fp: 
+		fp.write('%s\n%d\n'%(incoming['title'],len(records)))
+		for line in records: fp.write(line+'\n')
+		fp.write(incoming['box_line']+'\n')
 	shutil.move(wordspace.step+top,wordspace.step+'system.old.top')
 	write_top(top)
@@ -10,9 +10,11 @@ nnodes:             1
 
 from amx import *
 init(settings)
-from amx.base.gromacs import prepare_machine_configuration,prepare_gmxpaths
+from amx.base.gromacs import prepare_machine_configuration,prepare_gmxpaths,load_modules
 machine_configuration,this_machine = prepare_machine_configuration(hostname=wordspace.hostname)
 machine_configuration['walltime'] = wordspace.walltime
+#---gmxpaths no longer loads modules on import so we load the modules for this machine before the probe
+load_modules(machine_configuration,this_machine)
 gmxpaths = prepare_gmxpaths(machine_configuration,override=True)
 assert wordspace.hostname!='LOCAL'
 #---assume that we write the cluster script on the last step
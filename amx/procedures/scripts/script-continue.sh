@@ -43,4 +43,7 @@ cmd="$MDRUN -s $(printf md.part%04d.tpr $NRUN) \
 cmdexec=$cmd" &> log-$log"
 echo "[FUNCTION] gmx_run ('"$cmd"',) {'skip': False, 'log': '$log', 'inpipe': None}" >> $metalog
 eval $cmdexec
+
+#---record the new part in the project manifest
+(cd .. && python amx/base/manifest.py $step &> /dev/null)
 echo "[STATUS] done continuation stage"